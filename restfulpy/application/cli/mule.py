@@ -1,5 +1,4 @@
-import signal
-import sys
+from datetime import timedelta
 
 from easycli import SubCommand, Argument
 from nanohttp import settings
@@ -23,13 +22,24 @@ class StartSubSubCommand(SubCommand):
             action='append',
             help='Task status to process',
         ),
+        Argument(
+            '-n',
+            '--number-of-threads',
+            type=int,
+            default=None,
+            help='Number of workers to run in parallel.',
+        ),
+        Argument(
+            '--fork',
+            action='store_true',
+            default=None,
+            help='Run the workers as forked processes instead of threads.',
+        ),
     ]
 
     def __call__(self, args):
         from restfulpy.mule import worker
-
-        signal.signal(signal.SIGINT, self.kill_signal_handler)
-        signal.signal(signal.SIGTERM, self.kill_signal_handler)
+        from restfulpy.supervisor import Supervisor
 
         if not args.status:
             args.status = {'new'}
@@ -37,22 +47,35 @@ class StartSubSubCommand(SubCommand):
         if args.query_interval is not None:
             settings.jobs.merge({'interval': args.query_interval})
 
+        if args.number_of_threads is not None:
+            settings.jobs.merge({
+                'number_of_threads': args.number_of_threads
+            })
+
+        if args.fork is not None:
+            settings.jobs.merge({'fork': args.fork})
+
         print(
             f'The following task types would be processed with of interval'
             f'{settings.jobs.interval}s:'
         )
         print('Tracking task status(es): %s' % ','.join(args.status))
-
-        worker(statuses=args.status)
         print('Press Ctrl+C to terminate worker')
 
-    @staticmethod
-    def kill_signal_handler(signal_number, frame):
-        print('Terminating')
-        sys.stdin.close()
-        sys.stderr.close()
-        sys.stdout.close()
-        sys.exit(signal_number)
+        if settings.jobs.fork:
+            # Preventing to share the pooled connections with the children
+            args.application.engine.dispose()
+
+        supervisor = Supervisor(
+            worker,
+            number_of_workers=settings.jobs.number_of_threads,
+            fork=settings.jobs.fork,
+            initializer=args.application.initialize_orm \
+                if settings.jobs.fork else None,
+            drain_timeout=settings.jobs.drain_timeout,
+            statuses=args.status,
+        )
+        supervisor.run()
 
 
 class RenewSubSubCommand(SubCommand):
@@ -77,11 +100,39 @@ class RenewSubSubCommand(SubCommand):
         renew()
 
 
+class StatsSubSubCommand(SubCommand):
+    __command__ = 'stats'
+    __help__ = 'Shows the number of the jobs by status and type'
+    __arguments__ = [
+        Argument(
+            '-a',
+            '--all',
+            action='store_true',
+            help='Include the finished jobs, requires a full table scan',
+        ),
+    ]
+
+    def __call__(self, args):
+        from restfulpy.mule import MuleTask
+        from restfulpy.orm import DBSession
+
+        rows = MuleTask.get_stats(
+            statuses=None if args.all else ('new', 'in-progress'),
+            session=DBSession,
+        )
+        print(f'{"STATUS":<12} {"TYPE":<30} {"COUNT":>10} {"OLDEST":>16}')
+        for status, type_, count, age in rows:
+            # The age of the scheduled jobs is negative
+            age = str(timedelta(seconds=int(age))) if age and age > 0 else '-'
+            print(f'{status:<12} {type_:<30} {count:>10} {age:>16}')
+
+
 class MuleSubCommand(SubCommand):
     __command__ = 'mule'
     __help__ = 'Jobs queue administration'
     __arguments__ = [
         StartSubSubCommand,
+        StatsSubSubCommand,
         RenewSubSubCommand,
     ]
 
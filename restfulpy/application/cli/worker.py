@@ -1,5 +1,3 @@
-import signal
-import sys
 from datetime import datetime, timedelta
 
 from easycli import SubCommand, Argument
@@ -24,13 +22,44 @@ class StartSubSubCommand(SubCommand):
             action='append',
             help='Task status to process',
         ),
+        Argument(
+            '-b',
+            '--batch-size',
+            type=int,
+            default=None,
+            help='Number of tasks to pop at once.',
+        ),
+        Argument(
+            '-n',
+            '--number-of-threads',
+            type=int,
+            default=None,
+            help='Number of workers to run in parallel.',
+        ),
+        Argument(
+            '--fork',
+            action='store_true',
+            default=None,
+            help='Run the workers as forked processes instead of threads.',
+        ),
+        Argument(
+            '--async',
+            dest='async_',
+            action='store_true',
+            help='Run the tasks which implement do_async using asyncio.',
+        ),
+        Argument(
+            '-c',
+            '--concurrency',
+            type=int,
+            default=None,
+            help='Maximum number of tasks in flight per async worker.',
+        ),
     ]
 
     def __call__(self, args):
-        from restfulpy.taskqueue import worker
-
-        signal.signal(signal.SIGINT, self.kill_signal_handler)
-        signal.signal(signal.SIGTERM, self.kill_signal_handler)
+        from restfulpy.supervisor import Supervisor
+        from restfulpy.taskqueue import worker, run_async_worker
 
         if not args.status:
             args.status = {'new'}
@@ -38,22 +67,42 @@ class StartSubSubCommand(SubCommand):
         if args.gap is not None:
             settings.worker.merge({'gap': args.gap})
 
+        if args.batch_size is not None:
+            settings.worker.merge({'batch_size': args.batch_size})
+
+        if args.number_of_threads is not None:
+            settings.worker.merge({
+                'number_of_threads': args.number_of_threads
+            })
+
+        if args.fork is not None:
+            settings.worker.merge({'fork': args.fork})
+
+        if args.concurrency is not None:
+            settings.worker.merge({'concurrency': args.concurrency})
+
         print(
             f'The following task types would be processed with gap of '
             f'{settings.worker.gap}s:'
         )
         print('Tracking task status(es): %s' % ','.join(args.status))
-
-        worker(statuses=args.status, filters=args.filter)
         print('Press Ctrl+C to terminate worker')
 
-    @staticmethod
-    def kill_signal_handler(signal_number, frame):
-        print('Terminating')
-        sys.stdin.close()
-        sys.stderr.close()
-        sys.stdout.close()
-        sys.exit(signal_number)
+        if settings.worker.fork:
+            # Preventing to share the pooled connections with the children
+            args.application.engine.dispose()
+
+        supervisor = Supervisor(
+            run_async_worker if args.async_ else worker,
+            number_of_workers=settings.worker.number_of_threads,
+            fork=settings.worker.fork,
+            initializer=args.application.initialize_orm \
+                if settings.worker.fork else None,
+            drain_timeout=settings.worker.drain_timeout,
+            statuses=args.status,
+            filters=args.filter,
+        )
+        supervisor.run()
 
 
 class CleanupSubSubCommand(SubCommand):
@@ -67,6 +116,21 @@ class CleanupSubSubCommand(SubCommand):
             type=int,
             help='The number of days you want to clear previous tasks',
         ),
+        Argument(
+            '-b',
+            '--batch-size',
+            default=None,
+            type=int,
+            help='Number of tasks to delete in each transaction',
+        ),
+        Argument(
+            '-a',
+            '--archive-table',
+            default=None,
+            help='Move the tasks into this table instead of deleting them, '
+                 'and the rows of the subclasses\' tables into the '
+                 '<archive-table>_<table> tables',
+        ),
     ]
 
     def __call__(self, args):
@@ -76,8 +140,79 @@ class CleanupSubSubCommand(SubCommand):
         days = args.days or settings.worker.cleanup_time_limitation
         time_limitation = datetime.utcnow() - timedelta(days=days)
 
-        RestfulpyTask.cleanup(time_limitation, DBSession)
+        deleted = RestfulpyTask.cleanup(
+            time_limitation,
+            DBSession,
+            batch_size=args.batch_size,
+            archive_table=args.archive_table,
+        )
         DBSession.commit()
+        print(f'{deleted} task(s) are cleaned up')
+
+
+class PartitionSubSubCommand(SubCommand):
+    __command__ = 'partition'
+    __help__ = 'Create the upcoming partitions and drop the old ones'
+    __arguments__ = [
+        Argument(
+            '-d',
+            '--days',
+            default=None,
+            type=int,
+            help='The number of days you want to keep the partitions',
+        ),
+        Argument(
+            '-a',
+            '--ahead',
+            default=None,
+            type=int,
+            help='Number of the upcoming partitions to create',
+        ),
+    ]
+
+    def __call__(self, args):
+        from restfulpy.orm import DBSession
+        from restfulpy.taskqueue import RestfulpyTask
+
+        days = args.days or settings.worker.cleanup_time_limitation
+        time_limitation = datetime.utcnow() - timedelta(days=days)
+
+        RestfulpyTask.maintain_partitions(
+            time_limitation,
+            DBSession,
+            ahead=args.ahead,
+        )
+
+
+class StatsSubSubCommand(SubCommand):
+    __command__ = 'stats'
+    __help__ = 'Shows the number of the tasks by status, type and priority'
+    __arguments__ = [
+        Argument(
+            '-a',
+            '--all',
+            action='store_true',
+            help='Include the finished tasks, requires a full table scan',
+        ),
+    ]
+
+    def __call__(self, args):
+        from restfulpy.orm import DBSession
+        from restfulpy.taskqueue import RestfulpyTask
+
+        rows = RestfulpyTask.get_stats(
+            statuses=None if args.all else ('new', 'in-progress'),
+            session=DBSession,
+        )
+        print(
+            f'{"STATUS":<12} {"TYPE":<30} {"PRIORITY":>8} {"COUNT":>10} '
+            f'{"OLDEST":>16}'
+        )
+        for status, type_, priority, count, age in rows:
+            print(
+                f'{status:<12} {type_:<30} {priority:>8} {count:>10} '
+                f'{str(timedelta(seconds=int(age))):>16}'
+            )
 
 
 class RenewSubSubCommand(SubCommand):
@@ -116,6 +251,8 @@ class WorkerSubCommand(SubCommand):
         ),
         StartSubSubCommand,
         CleanupSubSubCommand,
+        PartitionSubSubCommand,
+        StatsSubSubCommand,
         RenewSubSubCommand,
     ]
 
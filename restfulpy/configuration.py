@@ -18,6 +18,7 @@ timestamp: false
 #   - !!python/object/apply:datetime.timedelta [0, 7200, 0]
 #   - myzone
 timezone:
+is_database_sharding: false
 
 db:
   # The main uri
@@ -102,19 +103,111 @@ authentication:
 worker:
   gap: .5
   number_of_threads: 1
+  # Run the workers as forked processes instead of threads
+  fork: false
+  # Seconds to wait for the running tasks on SIGINT and SIGTERM
+  drain_timeout: 30
+  # Number of tasks to claim per round trip
+  batch_size: 1
+  # Maximum number of tasks in flight per worker, when running with --async
+  concurrency: 100
+  # Number of tasks to insert per statement by `RestfulpyTask.enqueue_many`
+  enqueue_batch_size: 1000
+  # Set a channel name to wake up the idle workers using LISTEN/NOTIFY
+  # instead of sleeping for `gap` seconds after an empty pop.
+  notification_channel: ~
+  notification_timeout: 30 # Seconds
   cleanup_time_limitation: 10 # Days
+  # Number of tasks to delete in each transaction
+  cleanup_batch_size: 1000
+  # Move the cleaned up tasks into this table instead of just deleting them.
+  # The table should have the restfulpy_task's columns, i.e:
+  # CREATE TABLE restfulpy_task_history (LIKE restfulpy_task)
+  #   PARTITION BY RANGE (created_at)
+  # The rows of the subclasses' tables are moved into the
+  # <cleanup_archive_table>_<table> tables, i.e:
+  # CREATE TABLE restfulpy_task_history_email (LIKE email)
+  cleanup_archive_table: ~
+  # Partition the restfulpy_task and its subclasses' tables by id ranges when
+  # creating the schema. The `worker partition` command should be run
+  # periodically to create the upcoming partitions and drop the old ones.
+  partitioning:
+    enabled: false
+    interval: 1000000 # Tasks per partition
+    ahead: 2 # Number of the upcoming partitions to keep ready
 
 renew_worker:
   time_range: 5 # Minutes
   gap: 300 # Seconds
+  batch_size: 1000 # Tasks to renew in each transaction
 
 renew_mule_worker:
   time_range: 5 # Minutes
   gap: 300 # Seconds
+  batch_size: 1000 # Jobs to renew in each transaction
 
 jobs:
   interval: .5 # Seconds
   number_of_threads: 1
+  # Run the workers as forked processes instead of threads
+  fork: false
+  # Seconds to wait for the running jobs on SIGINT and SIGTERM
+  drain_timeout: 30
+  # Set a channel name to wake up the idle workers using LISTEN/NOTIFY,
+  # Ignored when the database sharding is enabled.
+  notification_channel: ~
+  notification_timeout: 30 # Seconds
+
+# The leases of the claimed tasks and jobs, extended by their workers.
+lease:
+  # Seconds, the tasks and jobs are renewed by `worker renew` and
+  # `mule renew` when their worker does not extend the lease in this
+  # period. Set to ~ to disable the leases.
+  duration: 60
+  heartbeat_interval: 20 # Seconds
+
+sharding:
+  # Number of threads to run the shards in parallel, per worker
+  threads: 8
+  # Seconds to wait before running an idle shard again
+  interval: .5
+  # Seconds to cache the list of the shards
+  refresh_interval: 60
+  # Publish to this redis channel to refresh the list of the shards
+  # immediately, see `restfulpy.sharding.notify_shards_changed`.
+  notification_channel: restfulpy:shards
+  # Name of this host, defaults to the hostname.
+  host: ~
+  # The shards are distributed between these hosts using consistent
+  # hashing, leave it empty to run all of the shards on each host.
+  hosts: []
+  # The engines of the shards, created lazily by the ShardEngineRegistry
+  engines:
+    max_engines: 50
+    pool_size: 2
+    max_overflow: 3
+    # Seconds, the unused engines are disposed after this period
+    idle_timeout: 600
+    # Seconds to check the connection string of a shard again
+    refresh_interval: 300
+
+metrics:
+  # The sink to report the metrics of the task queue and the mule workers:
+  # restfulpy.metrics.NullSink
+  # restfulpy.metrics.LogSink
+  # restfulpy.metrics.StatsDSink
+  # restfulpy.metrics.PrometheusFileSink
+  sink: restfulpy.metrics.NullSink
+  flush_interval: 10 # Seconds
+  # Upper bounds of the histograms' buckets, in seconds
+  buckets: [.01, .05, .1, .5, 1, 5, 10, 30, 60, 300, 1800, 3600]
+  statsd:
+    host: localhost
+    port: 8125
+    prefix: restfulpy
+  prometheus:
+    # {pid} is replaced by the process id
+    filename: /tmp/restfulpy-{pid}.prom
 
 smtp:
   host: smtp.example.com
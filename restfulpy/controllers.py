@@ -1,9 +1,21 @@
-from nanohttp import Controller, context, json, RestController, action
+from nanohttp import Controller, context, RestController, action
 
+from restfulpy.exceptions import HTTPNotModified
 from restfulpy.helpers import split_url
 from restfulpy.orm import DBSession
 
 
+def if_none_match():
+    """Returns the ETags of the `If-None-Match` request header."""
+    header = context.environ.get('HTTP_IF_NONE_MATCH')
+    if not header:
+        return set()
+
+    return {
+        tag.strip().replace('W/', '', 1) for tag in header.split(',')
+    }
+
+
 class RootController(Controller):
 
     def __call__(self, *remaining_paths):
@@ -22,9 +34,15 @@ class RootController(Controller):
 class ModelRestController(RestController):
     __model__ = None
 
-    @json
+    @action(content_type='application/json')
     def metadata(self):
-        return self.__model__.json_metadata()
+        body, etag = self.__model__.get_metadata_response()
+        tags = if_none_match()
+        if etag in tags or '*' in tags:
+            raise HTTPNotModified(etag)
+
+        context.response_headers.add_header('ETag', etag)
+        return body
 
 
 
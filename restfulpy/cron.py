@@ -0,0 +1,101 @@
+from datetime import datetime, timedelta
+
+
+class CronExpression:
+    """A five fields cron expression: minute, hour, day of month, month
+    and day of week.
+
+    Each field accepts `*`, a number, a range `a-b`, a step `*/n` or
+    `a-b/n` and a comma separated list of them. Sunday is both 0 and 7 in
+    the day of week. As in cron, when both the day of month and the day of
+    week are restricted, a day matching either of them is matched.
+    """
+
+    fields = (
+        ('minute', 0, 59),
+        ('hour', 0, 23),
+        ('day', 1, 31),
+        ('month', 1, 12),
+        ('weekday', 0, 7),
+    )
+
+    def __init__(self, expression):
+        self.expression = expression
+        parts = expression.split()
+        if len(parts) != len(self.fields):
+            raise ValueError(f'Invalid cron expression: {expression}')
+
+        values = [
+            self.parse_field(part, minimum, maximum)
+            for part, (_, minimum, maximum) in zip(parts, self.fields)
+        ]
+        self.minutes, self.hours, self.days, self.months, weekdays = values
+
+        # Sunday
+        if 7 in weekdays:
+            weekdays = (weekdays - {7}) | {0}
+
+        self.weekdays = weekdays
+        self.any_day = parts[2] == '*'
+        self.any_weekday = parts[4] == '*'
+
+    def __repr__(self):
+        return f'CronExpression({self.expression!r})'
+
+    @staticmethod
+    def parse_field(field, minimum, maximum):
+        values = set()
+        for item in field.split(','):
+            range_, _, step = item.partition('/')
+            step = int(step) if step else 1
+            if range_ == '*':
+                start, stop = minimum, maximum
+            elif '-' in range_:
+                start, stop = map(int, range_.split('-'))
+            else:
+                start = int(range_)
+                stop = maximum if step > 1 else start
+
+            if not minimum <= start <= stop <= maximum or step < 1:
+                raise ValueError(f'Invalid cron field: {field}')
+
+            values.update(range(start, stop + 1, step))
+
+        return values
+
+    def match_day(self, moment):
+        day = moment.day in self.days
+        # Python's Monday is 0, cron's is 1
+        weekday = (moment.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day and weekday
+
+        return day or weekday
+
+    def next(self, after):
+        """Returns the first matching minute after the given naive datetime.
+        """
+        moment = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = moment + timedelta(days=5 * 366)
+        while moment < limit:
+            if moment.month not in self.months:
+                year, month = divmod(moment.month, 12)
+                moment = datetime(moment.year + year, month + 1, 1)
+                continue
+
+            if not self.match_day(moment):
+                moment = datetime(moment.year, moment.month, moment.day) + \
+                    timedelta(days=1)
+                continue
+
+            if moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + timedelta(hours=1)
+                continue
+
+            if moment.minute not in self.minutes:
+                moment += timedelta(minutes=1)
+                continue
+
+            return moment
+
+        raise ValueError(f'{self.expression} never matches')
@@ -1,9 +1,14 @@
 import contextlib
+import select
+import time
 from urllib.parse import urlparse
 
 import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
 from nanohttp import settings
 from sqlalchemy import create_engine, text
+from sqlalchemy.event import listen
+from sqlalchemy.orm import Session
 
 
 class PostgreSQLManager:
@@ -72,3 +77,80 @@ class PostgreSQLManager:
             (f'public.{name}',)
         ) as c:
             return c.fetchone()[0] is not None
+
+
+class PostgreSQLListener:
+    """Waits for the `NOTIFY` events of a channel on a dedicated connection.
+    """
+    connection = None
+
+    def __init__(self, channel, url=None):
+        self.channel = channel
+        self.db_url = url or settings.db.url
+
+    def __enter__(self):
+        return self.listen()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def listen(self):
+        self.connection = psycopg2.connect(self.db_url)
+        self.connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        cursor = self.connection.cursor()
+        cursor.execute(f'LISTEN "{self.channel}"')
+        cursor.close()
+        return self
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def wait(self, timeout, stop=None):
+        """Blocks until a notification arrives or the timeout is elapsed.
+
+        :param timeout: Maximum seconds to wait.
+        :param stop: An optional event, checked every second to give up
+                     waiting when it's set.
+        :return: `True` if at least one notification is received.
+        """
+        self.connection.poll()
+        deadline = time.monotonic() + timeout
+        while not self.connection.notifies:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or (stop is not None and stop.is_set()):
+                break
+
+            if stop is not None:
+                remaining = min(remaining, 1)
+
+            select.select([self.connection], [], [], remaining)
+            self.connection.poll()
+
+        notified = bool(self.connection.notifies)
+        self.connection.notifies.clear()
+        return notified
+
+
+def notify(connection, channel, payload=''):
+    """Issues a `NOTIFY`, it's delivered when the transaction is committed.
+    """
+    connection.execute(
+        text('SELECT pg_notify(:channel, :payload)'),
+        dict(channel=channel, payload=payload),
+    )
+
+
+def notify_on_flush(cls, get_channel):
+    """Issues one `NOTIFY` per flush which inserts any instance of `cls`,
+    instead of one per inserted row.
+
+    :param get_channel: A callable returning the channel or `None` to skip.
+    """
+    def after_flush(session, flush_context):
+        channel = get_channel()
+        if channel and any(isinstance(o, cls) for o in session.new):
+            notify(session.connection(), channel)
+
+    listen(Session, 'after_flush', after_flush)
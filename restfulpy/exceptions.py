@@ -1,4 +1,4 @@
-from nanohttp import HTTPStatus
+from nanohttp import HTTPStatus, HTTPNotModified as NanohttpNotModified
 
 
 class RestfulException(Exception):
@@ -18,6 +18,22 @@ class UnsupportedError(Exception):
     pass
 
 
+class HTTPNotModified(NanohttpNotModified):
+    """Keeps the ETag of the resource in the 304 response."""
+
+    def __init__(self, etag):
+        super().__init__()
+        self.etag = etag
+
+    @property
+    def headers(self):
+        return super().headers + [('ETag', self.etag)]
+
+    def render(self):
+        # A 304 response must not have a body
+        return ''
+
+
 class SQLError(HTTPStatus):
 
     def __init__(self, sqlalchemy_error):
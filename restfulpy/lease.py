@@ -0,0 +1,175 @@
+import os
+import socket
+import threading
+from datetime import datetime, timedelta
+
+from nanohttp import settings, context as ctx
+from sqlalchemy import select, or_, and_
+
+from .db import notify
+from .helpers import with_context
+from .logging_ import get_logger
+from .metrics import get_metrics_sink, report_renewed
+from .orm import create_thread_unsafe_session
+
+
+logger = get_logger('lease')
+
+
+def generate_worker_id():
+    return f'{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}'
+
+
+def get_lease_values(worker_id):
+    """Returns the values to lease the claimed rows to the worker for
+    `settings.lease.duration` seconds, nothing when the leases are disabled
+    or the `worker_id` is not given.
+    """
+    if worker_id is None or not settings.lease.duration:
+        return {}
+
+    return dict(
+        worker_id=worker_id,
+        lease_expires_at=datetime.utcnow() + \
+            timedelta(seconds=settings.lease.duration),
+    )
+
+
+def start_heartbeat(cls):
+    """Generates the id of the current worker and starts a
+    :class:`Heartbeat` to extend the leases of its rows of the `cls`.
+
+    :return: `(worker_id, heartbeat)`, the heartbeat is `None` when the
+             leases are disabled.
+    """
+    worker_id = generate_worker_id()
+    if not settings.lease.duration:
+        return worker_id, None
+
+    heartbeat = Heartbeat(
+        cls.__table__,
+        worker_id,
+        settings.lease.duration,
+        settings.lease.heartbeat_interval,
+    )
+    heartbeat.start()
+    return worker_id, heartbeat
+
+
+def stop_heartbeat(heartbeat):
+    if heartbeat is not None:
+        heartbeat.stop()
+
+
+class Heartbeat(threading.Thread):
+    """Extends the leases of the claimed tasks periodically.
+
+    The worker should :meth:`add` the tasks as soon as it claims them and
+    :meth:`discard` them when they are finished.
+    """
+
+    def __init__(self, table, worker_id, lease, interval):
+        super().__init__(name=f'heartbeat-{table.name}', daemon=True)
+        self.table = table
+        self.worker_id = worker_id
+        self.lease = lease
+        self.interval = interval
+        self.tasks = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def add(self, task_id, shard_key=None):
+        with self.lock:
+            self.tasks[task_id] = shard_key
+
+    def discard(self, task_id):
+        with self.lock:
+            self.tasks.pop(task_id, None)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    @with_context
+    def run(self):
+        session = create_thread_unsafe_session()
+        try:
+            while not self.stopped.wait(self.interval):
+                try:
+                    self.beat(session)
+                except Exception as exp:
+                    session.rollback()
+                    logger.error(exp, exc_info=True)
+        finally:
+            session.close()
+
+    def beat(self, session):
+        with self.lock:
+            shards = {}
+            for task_id, shard_key in self.tasks.items():
+                shards.setdefault(shard_key, []).append(task_id)
+
+        for shard_key, task_ids in shards.items():
+            ctx.shard_key = shard_key
+            session.execute(
+                self.table.update()
+                .where(self.table.c.id.in_(task_ids))
+                .where(self.table.c.worker_id == self.worker_id)
+                .values(
+                    lease_expires_at=datetime.utcnow() + \
+                        timedelta(seconds=self.lease)
+                )
+            )
+            session.commit()
+
+
+def renew_expired_leases(cls, queue, in_progress, new, time_limitation,
+                         session, batch_size, notification_channel=None):
+    """Resets the rows of the `cls` from the `in_progress` to the `new`
+    status, which have an expired lease, And the ones without a lease which
+    are started before the `time_limitation`.
+
+    Each batch is updated by a single statement and committed, then the
+    renewed rows are reported as `<queue>_renewed_total` by type, and the
+    `notification_channel` is notified if it's given.
+
+    :return: The types of the renewed rows.
+    """
+    table = cls.__table__
+    metrics = get_metrics_sink()
+    renewed = []
+
+    while True:
+        stale_query = select(table.c.id) \
+            .where(table.c.status == in_progress) \
+            .where(or_(
+                table.c.lease_expires_at <= datetime.utcnow(),
+                and_(
+                    table.c.lease_expires_at.is_(None),
+                    table.c.started_at <= time_limitation,
+                )
+            )) \
+            .limit(batch_size) \
+            .with_for_update(skip_locked=True) \
+            .subquery('stale_query')
+
+        update_query = table.update() \
+            .where(table.c.id == stale_query.c.id) \
+            .values(
+                status=new,
+                started_at=None,
+                terminated_at=None,
+                worker_id=None,
+                lease_expires_at=None,
+            ) \
+            .returning(table.c.id, table.c.type)
+
+        types = [row.type for row in session.execute(update_query)]
+        if types and notification_channel:
+            notify(session, notification_channel)
+
+        session.commit()
+        report_renewed(metrics, queue, types)
+        renewed.extend(types)
+        if len(types) < batch_size:
+            return renewed
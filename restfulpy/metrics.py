@@ -0,0 +1,235 @@
+import os
+import socket
+import threading
+import time
+from collections import Counter
+
+from nanohttp import settings
+
+from .helpers import construct_class_by_name
+from .logging_ import get_logger
+
+
+logger = get_logger('metrics')
+
+
+class MetricsSink:
+    """The abstract base class of the metrics sinks.
+
+    The workers report the counters using :meth:`increment` and the
+    durations, in seconds, using :meth:`observe`.
+    """
+
+    def increment(self, name, value=1, **labels):
+        raise NotImplementedError
+
+    def observe(self, name, value, **labels):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+
+class NullSink(MetricsSink):
+
+    def increment(self, name, value=1, **labels):
+        pass
+
+    def observe(self, name, value, **labels):
+        pass
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+
+        self.sum += value
+        self.count += 1
+
+
+class AggregatingSink(MetricsSink):
+    """Keeps the metrics in memory and writes them every
+    `settings.metrics.flush_interval` seconds.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.buckets = sorted(settings.metrics.buckets)
+        self.next_flush = time.monotonic() + settings.metrics.flush_interval
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+        self._flush_if_due()
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.buckets)
+
+            histogram.observe(value)
+
+        self._flush_if_due()
+
+    def _flush_if_due(self):
+        if time.monotonic() >= self.next_flush:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            self.next_flush = \
+                time.monotonic() + settings.metrics.flush_interval
+            self.write(self.counters, self.histograms)
+
+    def write(self, counters, histograms):
+        raise NotImplementedError
+
+
+def format_labels(labels):
+    return ','.join(f'{k}="{v}"' for k, v in labels)
+
+
+class LogSink(AggregatingSink):
+    """Logs the metrics of each interval, then resets them."""
+
+    def write(self, counters, histograms):
+        for (name, labels), value in sorted(counters.items()):
+            logger.info(f'{name}{{{format_labels(labels)}}} {value}')
+
+        for (name, labels), histogram in sorted(histograms.items()):
+            logger.info(
+                f'{name}{{{format_labels(labels)}}} '
+                f'count={histogram.count} '
+                f'avg={histogram.sum / histogram.count:.3f}'
+            )
+
+        counters.clear()
+        histograms.clear()
+
+
+class PrometheusFileSink(AggregatingSink):
+    """Writes the metrics using the Prometheus text format, to be exported
+    by the node exporter's textfile collector.
+
+    The file is replaced atomically, and `{pid}` in its name is replaced by
+    the process id, so the forked workers don't overwrite each other's.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.filename = settings.metrics.prometheus.filename.format(
+            pid=os.getpid()
+        )
+
+    def write(self, counters, histograms):
+        lines = []
+        for (name, labels), value in sorted(counters.items()):
+            lines.append(f'{name}{{{format_labels(labels)}}} {value}')
+
+        for (name, labels), histogram in sorted(histograms.items()):
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                bucket_labels = labels + (('le', bound), )
+                lines.append(
+                    f'{name}_bucket{{{format_labels(bucket_labels)}}} {count}'
+                )
+
+            bucket_labels = labels + (('le', '+Inf'), )
+            lines.append(
+                f'{name}_bucket{{{format_labels(bucket_labels)}}} '
+                f'{histogram.count}'
+            )
+            lines.append(
+                f'{name}_sum{{{format_labels(labels)}}} {histogram.sum}'
+            )
+            lines.append(
+                f'{name}_count{{{format_labels(labels)}}} {histogram.count}'
+            )
+
+        temporary = f'{self.filename}.tmp'
+        with open(temporary, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+        os.replace(temporary, self.filename)
+
+
+class StatsDSink(MetricsSink):
+    """Sends each metric as a StatsD UDP packet, the values of the labels
+    are appended to the name.
+    """
+
+    def __init__(self):
+        self.address = (settings.metrics.statsd.host,
+                        settings.metrics.statsd.port)
+        self.prefix = settings.metrics.statsd.prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _name(self, name, labels):
+        parts = [self.prefix, name] if self.prefix else [name]
+        parts.extend(str(v) for _, v in sorted(labels.items()))
+        return '.'.join(parts)
+
+    def _send(self, packet):
+        try:
+            self.socket.sendto(packet.encode(), self.address)
+        except OSError as exp:
+            logger.error(f'Cannot send the metrics: {exp}')
+
+    def increment(self, name, value=1, **labels):
+        self._send(f'{self._name(name, labels)}:{value}|c')
+
+    def observe(self, name, value, **labels):
+        self._send(f'{self._name(name, labels)}:{value * 1000:.3f}|ms')
+
+
+_sink = None
+_sink_key = None
+_sink_lock = threading.Lock()
+
+
+def get_metrics_sink() -> MetricsSink:
+    """Returns the sink of the current process, an instance of the
+    `settings.metrics.sink`.
+    """
+    global _sink, _sink_key
+
+    key = (settings.metrics.sink, os.getpid())
+    with _sink_lock:
+        if _sink is None or _sink_key != key:
+            _sink = construct_class_by_name(settings.metrics.sink)
+            _sink_key = key
+
+        return _sink
+
+
+def report_task(sink, queue, type_, status, wait, duration):
+    """Reports an executed task of the `queue`, `task` or `job`.
+
+    :param wait: Seconds from creation to start.
+    :param duration: Seconds of the execution.
+    """
+    sink.increment(f'{queue}_finished_total', type=type_, status=status)
+    sink.observe(f'{queue}_wait_seconds', wait, type=type_)
+    sink.observe(f'{queue}_duration_seconds', duration, type=type_)
+
+
+def report_renewed(sink, queue, types):
+    """Reports the renewed tasks of the `queue`, `task` or `job`.
+
+    :param types: The type of each renewed task.
+    """
+    for type_, count in Counter(types).items():
+        sink.increment(f'{queue}_renewed_total', count, type=type_)
@@ -1,17 +1,28 @@
+import heapq
+import math
 import time
 import traceback
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 
 from nanohttp import settings, context as ctx
-from sqlalchemy import Integer, Enum, Unicode, DateTime, or_, and_
+from sqlalchemy import Integer, Enum, Unicode, DateTime, Boolean, Index, \
+    or_, and_, func, inspect
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import with_polymorphic
 from sqlalchemy.sql.expression import text
 
-from .helpers import get_shard_keys, with_context
+from .cron import CronExpression
+from .db import PostgreSQLListener, notify_on_flush
+from .helpers import with_context
+from .lease import renew_expired_leases, get_lease_values, start_heartbeat, \
+    stop_heartbeat
 from .logging_ import get_logger
+from .metrics import get_metrics_sink, report_task
 from .exceptions import RestfulException
 from .orm import TimestampMixin, DeclarativeBase, Field, DBSession, \
     create_thread_unsafe_session
+from .sharding import DEFAULT_SHARD_KEY, ShardScheduler, for_each_shard
 
 
 logger = get_logger('taskqueue')
@@ -60,7 +71,25 @@ class MuleTask(TimestampMixin, DeclarativeBase):
         nullable=True,
         json='startedAt',
     )
+    worker_id = Field(Unicode(128), nullable=True, json='workerId')
+    lease_expires_at = Field(
+        DateTime(timezone=True),
+        nullable=True,
+        json='leaseExpiresAt',
+    )
     type = Field(Unicode(50))
+    # Marks the occurrences of the types with a `__schedule__`
+    recurring = Field(
+        Boolean,
+        nullable=False,
+        default=False,
+        json='recurring',
+    )
+
+    # Set to a cron expression or an interval, a number of seconds or a
+    # timedelta, to run this type of jobs periodically. One occurrence is
+    # kept pending, and the next one is created when it's finished.
+    __schedule__ = None
 
     __mapper_args__ = {
         'polymorphic_identity': __tablename__,
@@ -71,50 +100,174 @@ class MuleTask(TimestampMixin, DeclarativeBase):
         raise NotImplementedError
 
     @classmethod
-    def pop(cls, statuses={'new'}, filters=None, session=DBSession):
+    def get_next_occurrence(cls, previous=None):
+        """Returns the time of the occurrence after the `previous` one, as
+        a naive UTC datetime.
+
+        The occurrences missed, i.e. when the workers are down, are skipped.
+        """
+        now = datetime.utcnow()
+        previous = _utc(previous) if previous is not None else now
+        schedule = cls.__schedule__
+        if isinstance(schedule, str):
+            return CronExpression(schedule).next(max(previous, now))
+
+        if not isinstance(schedule, timedelta):
+            schedule = timedelta(seconds=schedule)
+
+        if previous + schedule > now:
+            return previous + schedule
+
+        return previous + schedule * math.ceil((now - previous) / schedule)
+
+    @classmethod
+    def schedule_next(cls, previous=None, session=DBSession):
+        """Creates the next occurrence of this type, unless there's
+        already a pending one.
+
+        :return: The time of the created occurrence, `None` if not created.
+        """
+        at = cls.get_next_occurrence(previous)
+        try:
+            with session.begin_nested():
+                session.add(cls(at=at, recurring=True))
+
+        except IntegrityError:
+            return None
+
+        return at
+
+    @classmethod
+    def schedule_recurring(cls, session=DBSession):
+        """Creates the first occurrence of each type with a
+        `__schedule__`, if it's not already pending.
+        """
+        pending = {
+            t for t, in session.query(cls.type)
+            .filter(cls.recurring.is_(True))
+            .filter(cls.status.in_(['new', 'in-progress']))
+        }
+        for mapper in inspect(cls).self_and_descendants:
+            job_class = mapper.class_
+            if job_class.__schedule__ is None \
+                    or mapper.polymorphic_identity in pending:
+                continue
+
+            job_class.schedule_next(session=session)
+
+        session.commit()
+
+    @classmethod
+    def __declare_last__(cls):
+        notify_on_flush(cls, lambda: settings.jobs.notification_channel)
 
-        find_query = session.query(
-            cls.id.label('id'),
-            cls.created_at,
-            cls.at,
+    @classmethod
+    def get_stats(cls, statuses=('new', 'in-progress'), session=DBSession):
+        """Returns the number of the jobs and the seconds since the earliest
+        `at` of them, grouped by status and type.
+
+        The default statuses are covered by the partial index, pass `None`
+        to include the finished jobs too.
+        """
+        query = session.query(
             cls.status,
+            cls.type,
+            func.count(),
+            func.extract('epoch', func.now() - func.min(cls.at)),
+        )
+        if statuses is not None:
+            query = query.filter(cls.status.in_(statuses))
+
+        return query \
+            .group_by(cls.status, cls.type) \
+            .order_by(cls.status, cls.type) \
+            .all()
+
+    @classmethod
+    def pop(cls, statuses={'new'}, filters=None, session=DBSession,
+            worker_id=None):
+        tasks = cls.pop_many(
+            1,
+            statuses=statuses,
+            filters=filters,
+            session=session,
+            worker_id=worker_id,
         )
+        if not tasks:
+            raise TaskPopError('There is no task to pop')
+
+        return tasks[0]
+
+    @classmethod
+    def pop_many(cls, size, statuses={'new'}, filters=None,
+                 session=DBSession, worker_id=None):
+        """Claims up to `size` due jobs, the earliest first.
+
+        The in-progress jobs are never claimed again, and the rows locked
+        by the other workers are skipped instead of waiting for them. The
+        failed jobs are retried until their `expired_at`, if it's set.
+        """
+        now = datetime.utcnow()
+        find_query = session.query(cls.id.label('id'))
         if filters is not None:
             find_query = find_query.filter(
                 text(filters) if isinstance(filters, str) else filters
             )
 
         find_query = find_query \
-            .filter(cls.at <= datetime.utcnow()) \
-            .filter(
-                or_(
-                    cls.status == 'in-progress',
-                    cls.status == 'new',
-                    and_(
-                        cls.status == 'failed',
-                        cls.expired_at > datetime.utcnow()
-                    )
+            .filter(cls.at <= now) \
+            .filter(or_(
+                cls.status.in_(set(statuses) - {'in-progress'}),
+                and_(
+                    cls.status == 'failed',
+                    cls.expired_at > now,
                 )
-            ) \
-            .limit(1) \
-            .with_for_update()
+            )) \
+            .order_by(cls.at, cls.id) \
+            .limit(size) \
+            .with_for_update(skip_locked=True) \
+            .subquery('find_query')
+
+        values = dict(status='in-progress', started_at=now)
+        values.update(get_lease_values(worker_id))
 
-        cte = find_query.cte('find_query')
         update_query = MuleTask.__table__.update() \
-            .where(MuleTask.id == cte.c.id) \
-            .values(
-                status='in-progress',
-                started_at=datetime.utcnow(),
-            ) \
+            .where(MuleTask.id == find_query.c.id) \
+            .values(**values) \
             .returning(MuleTask.__table__.c.id)
 
-        task_id = session.execute(update_query).fetchone()
+        task_ids = [row[0] for row in session.execute(update_query)]
         session.commit()
-        if not task_id:
-            raise TaskPopError('There is no task to pop')
-        task_id = task_id[0]
-        task = session.query(cls).filter(cls.id == task_id).one()
-        return task
+        if not task_ids:
+            return []
+
+        polymorphic_task = with_polymorphic(cls, '*')
+        return session.query(polymorphic_task) \
+            .filter(polymorphic_task.id.in_(task_ids)) \
+            .order_by(polymorphic_task.at, polymorphic_task.id) \
+            .populate_existing() \
+            .all()
+
+    @classmethod
+    def renew_stale(cls, time_limitation, session=DBSession,
+                    batch_size=None):
+        """Resets the in-progress jobs with an expired lease, And the ones
+        without a lease which are started before the `time_limitation`.
+
+        See :func:`.lease.renew_expired_leases`.
+
+        :return: Number of the renewed jobs.
+        """
+        return len(renew_expired_leases(
+            MuleTask,
+            'job',
+            'in-progress',
+            'new',
+            time_limitation,
+            session,
+            batch_size or settings.renew_mule_worker.batch_size,
+            settings.jobs.notification_channel,
+        ))
 
     def execute(self, context, session=DBSession):
         try:
@@ -129,112 +282,326 @@ class MuleTask(TimestampMixin, DeclarativeBase):
             raise
 
 
+# A partial index to keep the pop and renew queries away from the finished
+# jobs.
+Index(
+    'ix_mule_task_pending',
+    MuleTask.__table__.c.at,
+    postgresql_where=MuleTask.__table__.c.status.in_(['new', 'in-progress']),
+)
+Index(
+    'ix_mule_task_retryable',
+    MuleTask.__table__.c.at,
+    postgresql_where=and_(
+        MuleTask.__table__.c.status == 'failed',
+        MuleTask.__table__.c.expired_at.isnot(None),
+    ),
+)
+Index(
+    'ix_mule_task_recurring',
+    MuleTask.__table__.c.type,
+    unique=True,
+    postgresql_where=and_(
+        MuleTask.__table__.c.recurring,
+        MuleTask.__table__.c.status.in_(['new', 'in-progress']),
+    ),
+)
+Index(
+    'ix_mule_task_lease',
+    MuleTask.__table__.c.lease_expires_at,
+    postgresql_where=MuleTask.__table__.c.status == 'in-progress',
+)
+
+
+def _utc(moment):
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+
+    return moment
+
+
+class JobTimer:
+    """A min-heap of the due times of the upcoming jobs, to sleep until
+    the next one, instead of polling the database.
+
+    It's loaded with the next `size` jobs from the database, when it's
+    empty or a new job is notified, and the scheduled occurrences are
+    pushed directly. When there are failed jobs to retry, the worker wakes
+    up after `settings.jobs.interval` seconds to retry them.
+
+    Without a notification channel, the worker sleeps up to
+    `settings.jobs.interval` seconds, so the jobs inserted by the other
+    processes are still picked up after the interval at most.
+    """
+
+    def __init__(self, size=100):
+        self.size = size
+        self.heap = []
+        self.stale = True
+
+    def push(self, at):
+        heapq.heappush(self.heap, _utc(at))
+
+    def load(self, session):
+        now = datetime.utcnow()
+        self.heap = [
+            _utc(at) for at, in session.query(MuleTask.at)
+            .filter(MuleTask.status == 'new')
+            .filter(MuleTask.at.isnot(None))
+            .order_by(MuleTask.at)
+            .limit(self.size)
+        ]
+        heapq.heapify(self.heap)
+
+        retryable = session.query(MuleTask.id) \
+            .filter(MuleTask.status == 'failed') \
+            .filter(MuleTask.expired_at > now) \
+            .exists()
+        if session.query(retryable).scalar():
+            self.push(now + timedelta(seconds=settings.jobs.interval))
+
+        self.stale = False
+        session.rollback()
+
+    def timeout(self, maximum):
+        """Returns the seconds until the next due job, up to the
+        `maximum`.
+        """
+        now = datetime.utcnow()
+        while self.heap and self.heap[0] <= now:
+            # Due, it's popped by now or will be in the next round
+            heapq.heappop(self.heap)
+            self.stale = not self.heap
+
+        if not self.heap:
+            return maximum
+
+        return min(maximum, (self.heap[0] - now).total_seconds())
+
+
+def _wait_for_jobs(listener, timer, session, stop=None):
+    if timer.stale:
+        timer.load(session)
+
+    if listener is None:
+        timeout = timer.timeout(settings.jobs.interval)
+        if stop is not None:
+            stop.wait(timeout)
+        else:
+            time.sleep(timeout)
+
+    elif listener.wait(
+        timer.timeout(settings.jobs.notification_timeout),
+        stop
+    ):
+        timer.stale = True
+
+
+def _execute_job(task, context, session, metrics, heartbeat=None,
+                 timer=None, shard_key=None):
+    if heartbeat is not None:
+        heartbeat.add(task.id, shard_key)
+
+    wait = (task.started_at - (task.at or task.created_at)).total_seconds()
+    started_at = time.monotonic()
+
+    try:
+        task.execute(context)
+
+        # Task success
+        task.status = 'success'
+        task.terminated_at = datetime.utcnow()
+
+    except Exception as exp:
+        task.status = 'failed'
+        if task.fail_reason != traceback.format_exc()[-4096:]:
+            task.fail_reason = traceback.format_exc()[-4096:]
+            logger.critical(dict(
+                message=f'Error when executing task: {task.id}',
+                taskId=task.id,
+                exception=exp.__doc__,
+                failReason=task.fail_reason,
+                shardKey=shard_key,
+            ))
+
+    finally:
+        try:
+            if session.is_active:
+                if task.recurring:
+                    at = type(task).schedule_next(task.at, session)
+                    if at is not None and timer is not None:
+                        timer.push(at)
+
+                session.commit()
+            report_task(
+                metrics,
+                'job',
+                task.type,
+                task.status,
+                wait,
+                time.monotonic() - started_at,
+            )
+        except Exception as exp:
+            logger.critical(exp, exc_info=True)
+
+        if heartbeat is not None:
+            heartbeat.discard(task.id)
+
+    return task.id, task.status
+
+
+def _pop_job(statuses, filters, session, metrics, worker_id):
+    claim_started_at = time.monotonic()
+    task = MuleTask.pop(
+        statuses=statuses,
+        filters=filters,
+        session=session,
+        worker_id=worker_id,
+    )
+    metrics.observe('job_claim_seconds', time.monotonic() - claim_started_at)
+    return task
+
+
 @with_context
-def worker(statuses={'new'}, filters=None, tries=-1):
+def worker(statuses={'new'}, filters=None, tries=-1, stop=None):
+    if settings.is_database_sharding:
+        return sharded_worker(statuses, filters, stop)
+
     isolated_session = create_thread_unsafe_session()
+    metrics = get_metrics_sink()
     context = {'counter': 0}
     tasks = []
-    shard_keys = [b'sharding:test:connection-string']
-
-    while True:
-        if settings.is_database_sharding:
-            shard_keys = get_shard_keys()
-
-        for shard_key in shard_keys:
-            shard_key = shard_key.decode()
-            shard_key = shard_key.replace(':connection-string', '')
-            shard_key = shard_key.replace('sharding:', '')
-            ctx.shard_key = shard_key
-
+    listener = None
+    timer = JobTimer()
+    if settings.jobs.notification_channel:
+        listener = PostgreSQLListener(
+            settings.jobs.notification_channel
+        ).listen()
+
+    worker_id, heartbeat = start_heartbeat(MuleTask)
+    ctx.shard_key = DEFAULT_SHARD_KEY
+
+    try:
+        MuleTask.schedule_recurring(isolated_session)
+        while stop is None or not stop.is_set():
+            popped = False
             context['counter'] += 1
 
             try:
-                task = MuleTask.pop(
-                    statuses=statuses,
-                    filters=filters,
-                    session=isolated_session
+                task = _pop_job(
+                    statuses,
+                    filters,
+                    isolated_session,
+                    metrics,
+                    worker_id,
                 )
-
-            except TaskPopError as ex:
+            except TaskPopError:
                 isolated_session.rollback()
                 if tries > -1:
                     tries -= 1
                     if tries <= 0:
                         return tasks
-                continue
+            else:
+                popped = True
+                tasks.append(_execute_job(
+                    task,
+                    context,
+                    isolated_session,
+                    metrics,
+                    heartbeat,
+                    timer,
+                    DEFAULT_SHARD_KEY,
+                ))
+
+            if popped:
+                if tasks[-1][1] != 'failed':
+                    # Draining the due jobs
+                    continue
 
-            try:
-                task.execute(context)
-
-                # Task success
-                task.status = 'success'
-                task.terminated_at = datetime.utcnow()
-
-            except Exception as exp:
-                task.status = 'failed'
-                if task.fail_reason != traceback.format_exc()[-4096:]:
-                    task.fail_reason = traceback.format_exc()[-4096:]
-                    logger.critical(dict(
-                        message=f'Error when executing task: {task.id}',
-                        taskId=task.id,
-                        exception=exp.__doc__,
-                        failReason=task.fail_reason,
-                        shardKey=shard_key,
-                    ))
-
-            finally:
-                try:
-                    if isolated_session.is_active:
-                        isolated_session.commit()
-                    tasks.append((task.id, task.status))
-                except Exception as exp:
-                    logger.critical(exp, exc_info=True)
-        time.sleep(settings.jobs.interval)
+                # To be retried after the interval
+                timer.stale = True
 
+            _wait_for_jobs(listener, timer, isolated_session, stop)
 
-@with_context
-def renew(session=DBSession):
-    shard_keys = [b'sharding:test:connection-string']
+        return tasks
 
-    while True:
-        renew_time_range = datetime.utcnow() - \
-            timedelta(minutes=settings.renew_mule_worker.time_range)
+    finally:
+        if listener is not None:
+            listener.close()
 
-        if settings.is_database_sharding:
-            shard_keys = get_shard_keys()
+        stop_heartbeat(heartbeat)
 
-        for shard_key in shard_keys:
-            shard_key = shard_key.decode()
-            shard_key = shard_key.replace(':connection-string', '')
-            shard_key = shard_key.replace('sharding:', '')
-            ctx.shard_key = shard_key
+        metrics.flush()
 
-            task_id = None
-            try:
-                task = session.query(MuleTask) \
-                    .with_for_update() \
-                    .filter(MuleTask.status == 'in-progress') \
-                    .filter(MuleTask.started_at <= renew_time_range) \
-                    .order_by(MuleTask.id) \
-                    .first()
-                if task is None:
-                    continue
 
-                task_id = task.id
-                task.status = 'new'
-                task.started_at = None
-                task.terminated_at = None
-                session.commit()
-                logger.info(f'Task: {task_id} successfully renewed.')
+def sharded_worker(statuses={'new'}, filters=None, stop=None):
+    """Runs the jobs of all of the shards owned by this host in parallel,
+    using a :class:`.ShardScheduler`.
+    """
+    metrics = get_metrics_sink()
+    worker_id, heartbeat = start_heartbeat(MuleTask)
+    contexts = {}
+    tasks = []
 
-            except OperationalError as exp:
-                logger.critical(exp, exc_info=True)
-                break
+    def work(shard_key, session):
+        context = contexts.get(shard_key)
+        if context is None:
+            MuleTask.schedule_recurring(session)
+            context = contexts[shard_key] = {'counter': 0}
 
-            except Exception as exp:
-                if task_id is not None:
-                    logger.error(f'Error when renewing task: {task_id}')
-                logger.error(exp, exc_info=True)
-                session.rollback()
-        time.sleep(settings.renew_mule_worker.gap)
+        context['counter'] += 1
+        try:
+            task = _pop_job(statuses, filters, session, metrics, worker_id)
+        except TaskPopError:
+            session.rollback()
+            return False
+
+        tasks.append(_execute_job(
+            task,
+            context,
+            session,
+            metrics,
+            heartbeat,
+            shard_key=shard_key,
+        ))
+
+        # The failed jobs are retried after the interval
+        return tasks[-1][1] != 'failed'
+
+    try:
+        ShardScheduler(
+            work,
+            interval=settings.jobs.interval,
+            name='mule',
+        ).run(stop)
+        return tasks
+
+    finally:
+        stop_heartbeat(heartbeat)
+
+        metrics.flush()
+
+
+@with_context
+def renew(session=DBSession):
+    def renew_shard(shard_key, session):
+        try:
+            renewed = MuleTask.renew_stale(renew_time_range, session)
+            if renewed:
+                logger.info(f'{renewed} task(s) successfully renewed.')
+
+        except OperationalError as exp:
+            logger.critical(exp, exc_info=True)
+            session.rollback()
+
+        except Exception as exp:
+            logger.error(f'Error when renewing tasks of: {shard_key}')
+            logger.error(exp, exc_info=True)
+            session.rollback()
 
+    while True:
+        renew_time_range = datetime.utcnow() - \
+            timedelta(minutes=settings.renew_mule_worker.time_range)
+
+        for_each_shard(renew_shard, session)
+        time.sleep(settings.renew_mule_worker.gap)
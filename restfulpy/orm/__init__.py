@@ -2,6 +2,7 @@ import functools
 from os.path import exists
 
 from nanohttp import settings, context
+from nanohttp.contexts import Context
 from sqlalchemy import create_engine as sa_create_engine, inspect
 from sqlalchemy.orm import scoped_session, sessionmaker, Session, \
     declarative_base
@@ -20,9 +21,30 @@ from .mixins import ModifiedMixin, SoftDeleteMixin, TimestampMixin, \
 from ..logging_ import logger
 
 
+class ShardedSession(Session):
+    """Binds to the engine of the current shard, `context.shard_key`, when
+    the database sharding is enabled, see :func:`init_model`.
+    """
+
+    shard_engines = None
+
+    def get_bind(self, mapper=None, **kwargs):
+        if self.shard_engines is not None:
+            shard_key = getattr(
+                getattr(Context.thread_local, 'nanohttp_context', None),
+                'shard_key',
+                None
+            )
+            if shard_key is not None:
+                return self.shard_engines.get(shard_key)
+
+        return super().get_bind(mapper, **kwargs)
+
+
 # Global session manager: DBSession() returns the Thread-local
 # session object appropriate for the current web request.
 session_factory = sessionmaker(
+    class_=ShardedSession,
     autoflush=False,
     autocommit=False,
     expire_on_commit=True,
@@ -35,10 +57,11 @@ metadata = MetaData()
 DeclarativeBase = declarative_base(cls=BaseModel, metadata=metadata)
 
 
-def create_engine(url=None, echo=None):
+def create_engine(url=None, echo=None, **kwargs):
     return sa_create_engine(
         url or settings.db.url,
-        echo=echo or settings.db.echo
+        echo=echo or settings.db.echo,
+        **kwargs
     )
 
 
@@ -50,6 +73,10 @@ def init_model(engine):
     """
     DBSession.remove()
     DBSession.configure(bind=engine)
+    ShardedSession.shard_engines = None
+    if settings.is_database_sharding:
+        from ..sharding import get_shard_engine_registry
+        ShardedSession.shard_engines = get_shard_engine_registry()
 
 
 def setup_schema(session=None):
@@ -75,8 +102,8 @@ def setup_schema(session=None):
             command.stamp(alembic_cfg, "head")
 
 
-def create_thread_unsafe_session():
-    return session_factory()
+def create_thread_unsafe_session(**kwargs):
+    return session_factory(**kwargs)
 
 
 def commit(func):
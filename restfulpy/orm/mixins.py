@@ -1,8 +1,13 @@
+import base64
 import re
-from datetime import datetime
+import uuid
+from datetime import datetime, date, time
+from decimal import Decimal
 
+import ujson
 from nanohttp import context, HTTPBadRequest
-from sqlalchemy import DateTime, between, desc, or_
+from sqlalchemy import DateTime, between, desc, or_, and_, false, tuple_, \
+    inspect
 from sqlalchemy.event import listen
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.sql.expression import nullslast, nullsfirst
@@ -177,21 +182,119 @@ class DeactivationMixin(ActivationMixin):
             self.deactivated_at = now
 
 
+def _is_nullable(column):
+    columns = getattr(getattr(column, 'property', None), 'columns', None)
+    return not columns or any(c.nullable for c in columns)
+
+
+def _python_type(column):
+    try:
+        return column.type.python_type
+    except (AttributeError, NotImplementedError):
+        return None
+
+
+def encode_cursor(values):
+    """Encodes the sort values of the last row of a page as an opaque
+    cursor.
+    """
+    values = [
+        v.isoformat() if isinstance(v, (datetime, date, time))
+        else str(v) if isinstance(v, (Decimal, uuid.UUID))
+        else v
+        for v in values
+    ]
+    return base64.urlsafe_b64encode(ujson.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor, columns):
+    try:
+        values = ujson.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if not isinstance(values, list) or len(values) != len(columns):
+            raise ValueError()
+
+        result = []
+        for column, value in zip(columns, values):
+            type_ = _python_type(column)
+            if value is not None and \
+                    type_ in (datetime, date, time, Decimal, uuid.UUID):
+                value = uuid.UUID(value) if type_ is uuid.UUID \
+                    else type_(value) if type_ is Decimal \
+                    else type_.fromisoformat(value)
+
+            result.append(value)
+
+        return result
+
+    except (ValueError, TypeError, AttributeError):
+        raise HTTPBadRequest('Invalid cursor')
+
+
+def seek(criteria, values):
+    """Returns the condition of the rows after the given sort values, in
+    the order of the criteria: `(column, descending)`.
+
+    The nulls are sorted last in ascending and first in descending order,
+    see :class:`OrderingMixin`.
+    """
+    directions = {descending for _, descending in criteria}
+    if len(directions) == 1 and None not in values and \
+            not any(_is_nullable(c) for c, _ in criteria):
+        columns = tuple_(*(c for c, _ in criteria))
+        if directions.pop():
+            return columns < tuple_(*values)
+        return columns > tuple_(*values)
+
+    clauses = []
+    equals = []
+    for (column, descending), value in zip(criteria, values):
+        if value is None:
+            after = column.isnot(None) if descending else false()
+            equal = column.is_(None)
+        else:
+            after = column < value if descending \
+                else or_(column > value, column.is_(None))
+            equal = column == value
+
+        clauses.append(and_(*equals, after))
+        equals.append(equal)
+
+    return or_(*clauses)
+
+
 class PaginationMixin:
     __take_header_key__ = 'HTTP_X_TAKE'
     __skip_header_key__ = 'HTTP_X_SKIP'
+    __cursor_header_key__ = 'HTTP_X_CURSOR'
     __max_take__ = 200
 
     @classmethod
-    def paginate_by_request(cls, query):
-
+    def _get_take(cls):
         try:
             take = int(
                 context.query.get('take') \
                 or context.environ.get(cls.__take_header_key__) \
                 or cls.__max_take__
             )
+        except ValueError:
+            raise HTTPBadRequest()
 
+        if take > cls.__max_take__:
+            raise HTTPBadRequest()
+
+        return take
+
+    @classmethod
+    def paginate_by_request(cls, query):
+        cursor = context.query.get('cursor')
+        if cursor is None:
+            cursor = context.environ.get(cls.__cursor_header_key__)
+
+        if cursor is not None:
+            return cls.paginate_by_cursor(query, cursor)
+
+        take = cls._get_take()
+        try:
             skip = int(
                 context.query.get('skip') \
                 or context.environ.get(cls.__skip_header_key__) \
@@ -200,9 +303,6 @@ class PaginationMixin:
         except ValueError:
             raise HTTPBadRequest()
 
-        if take > cls.__max_take__:
-            raise HTTPBadRequest()
-
         context.response_headers.add_header('X-Pagination-Take', str(take))
         context.response_headers.add_header('X-Pagination-Skip', str(skip))
         context.response_headers.add_header(
@@ -211,6 +311,49 @@ class PaginationMixin:
         )
         return query.offset(skip).limit(take)
 
+    @classmethod
+    def paginate_by_cursor(cls, query, cursor):
+        """Returns the page after the cursor, an empty cursor means the
+        first page.
+
+        The rows are sought by the values of the sort columns of the
+        request, see :meth:`OrderingMixin.get_sort_criteria_by_request`, or
+        by the primary key if it's not sorted. The cursor of the next page
+        is sent using the `X-Pagination-Cursor` header, unless this page is
+        not full. The total count is not calculated.
+        """
+        take = cls._get_take()
+        criteria = []
+        if issubclass(cls, OrderingMixin):
+            criteria = cls.get_sort_criteria_by_request()
+
+        if not criteria:
+            mapper = inspect(cls)
+            criteria = [
+                (getattr(cls, mapper.get_property_by_column(c).key), False)
+                for c in mapper.primary_key
+            ]
+            query = query.order_by(*(c for c, _ in criteria))
+
+        columns = [c for c, _ in criteria]
+        if cursor:
+            query = query.filter(
+                seek(criteria, decode_cursor(cursor, columns))
+            )
+
+        query = query.limit(take)
+        context.response_headers.add_header('X-Pagination-Take', str(take))
+        last = take and query.with_entities(*columns) \
+            .offset(take - 1) \
+            .first()
+        if last:
+            context.response_headers.add_header(
+                'X-Pagination-Cursor',
+                encode_cursor(last)
+            )
+
+        return query
+
 
 class FilteringMixin:
     @classmethod
@@ -308,10 +451,13 @@ class OrderingMixin:
         )
 
     @classmethod
-    def sort_by_request(cls, query):
+    def get_sort_criteria_by_request(cls):
+        """Returns the `(column, descending)` of the requested sort, the
+        `id` is appended if missing to make the order stable.
+        """
         sort_exp = context.query.get('sort', '').strip()
         if not sort_exp:
-            return query
+            return []
 
         sort_columns = [
             (
@@ -325,9 +471,11 @@ class OrderingMixin:
                ('id', 'desc') in sort_columns):
             sort_columns.append(('id', 'desc'))
 
-        criteria = cls.create_sort_criteria(sort_columns)
+        return cls.create_sort_criteria(sort_columns)
 
-        for criterion in criteria:
+    @classmethod
+    def sort_by_request(cls, query):
+        for criterion in cls.get_sort_criteria_by_request():
             query = cls._sort_by_key_value(query, *criterion)
 
         return query
@@ -1,15 +1,18 @@
+import copy
 import functools
 import uuid
 from datetime import datetime, date, time
 from decimal import Decimal
+from hashlib import md5
 
+import ujson
 from nanohttp import context, HTTPNotFound, HTTPBadRequest, validate
-from sqlalchemy import Column
+from sqlalchemy import Column, event
 from sqlalchemy.ext.associationproxy import AssociationProxyExtensionType
 from sqlalchemy.ext.hybrid import HybridExtensionType
 from sqlalchemy.inspection import inspect
 from sqlalchemy.orm import Query, CompositeProperty, \
-    RelationshipProperty
+    RelationshipProperty, Mapper, selectinload
 from sqlalchemy.orm.attributes import InstrumentedAttribute
 
 from ..datetimehelpers import parse_datetime, parse_date, parse_time, \
@@ -19,7 +22,107 @@ from .metadata import MetadataField
 from .mixins import PaginationMixin, FilteringMixin, OrderingMixin
 
 
+def export_value(v):
+    if v is None:
+        return v
+
+    if isinstance(v, datetime):
+        return format_datetime(v)
+
+    if isinstance(v, date):
+        return format_date(v)
+
+    if isinstance(v, time):
+        return format_time(v)
+
+    if hasattr(v, 'to_dict'):
+        return v.to_dict(include_mask_columns=False)
+
+    if isinstance(v, Decimal):
+        return str(v)
+
+    if isinstance(v, uuid.UUID):
+        return v.hex
+
+    return v
+
+
+def _export_list(v):
+    return [c.to_dict(include_mask_columns=False) for c in v]
+
+
+def _export_composite(v):
+    return v.__composite_values__()
+
+
+_formatters = {
+    datetime: format_datetime,
+    date: format_date,
+    time: format_time,
+    Decimal: str,
+    uuid.UUID: lambda v: v.hex,
+}
+
+
+def compile_converter(column):
+    """Returns the function to export the values of the column, specialized
+    by its python type.
+
+    The specialized functions fall back to :func:`export_value` for the
+    values of any other type, so the result is the same.
+    """
+    property_ = getattr(column, 'property', None)
+    if isinstance(property_, RelationshipProperty) and property_.uselist:
+        return _export_list
+
+    if isinstance(property_, CompositeProperty):
+        return _export_composite
+
+    try:
+        type_ = column.type.python_type
+    except (AttributeError, NotImplementedError):
+        return export_value
+
+    formatter = _formatters.get(type_)
+    if formatter is not None:
+        def convert(v):
+            return formatter(v) if type(v) is type_ else export_value(v)
+
+    elif type_ in (int, str, bool, float):
+        def convert(v):
+            return v if type(v) is type_ else export_value(v)
+
+    else:
+        return export_value
+
+    return convert
+
+
+# Compiled plans of the `BaseModel.to_dict`, by class and options
+_export_plans = {}
+
+# The metadata fields, documents and validation rules, by class
+_metadata = {}
+
+# The plans are not used if any of these methods is overridden
+_exporting_methods = (
+    'get_column',
+    'get_column_info',
+    'iter_columns',
+    'iter_json_columns',
+    'prepare_for_export',
+)
+
+
+@event.listens_for(Mapper, 'after_configured')
+def _clear_caches():
+    _export_plans.clear()
+    _metadata.clear()
+
+
 class BaseModel(object):
+    #: Number of the rows to fetch and to serialize at once when streaming
+    __stream_chunk_size__ = 500
 
     @classmethod
     def get_column(cls, column):
@@ -62,59 +165,66 @@ class BaseModel(object):
         if hasattr(column, 'property') \
                 and isinstance(column.property, RelationshipProperty) \
                 and column.property.uselist:
-            result = [c.to_dict(include_mask_columns=False) for c in v]
+            result = _export_list(v)
 
         elif hasattr(column, 'property') \
             and isinstance(column.property, CompositeProperty):
-            result = v.__composite_values__()
-
-        elif v is None:
-            result = v
-
-        elif isinstance(v, datetime):
-            result = format_datetime(v)
-
-        elif isinstance(v, date):
-            result = format_date(v)
-
-        elif isinstance(v, time):
-            result = format_time(v)
-
-        elif hasattr(v, 'to_dict'):
-            result = v.to_dict(include_mask_columns=False)
-
-        elif isinstance(v, Decimal):
-            result = str(v)
-
-        elif isinstance(v, uuid.UUID):
-            result = v.hex
+            result = _export_composite(v)
 
         else:
-            result = v
+            result = export_value(v)
 
         return param_name, result
 
     @classmethod
     def iter_metadata_fields(cls):
-        for c in cls.iter_json_columns(
-                relationships=True,
-                include_readonly_columns=True,
-                include_protected_columns=True
-        ):
-            yield from MetadataField.from_column(
-                cls.get_column(c),
-                info=cls.get_column_info(c)
+        key = (cls, 'fields')
+        fields = _metadata.get(key)
+        if fields is None:
+            fields = _metadata[key] = tuple(
+                f for c in cls.iter_json_columns(
+                    relationships=True,
+                    include_readonly_columns=True,
+                    include_protected_columns=True
+                )
+                for f in MetadataField.from_column(
+                    cls.get_column(c),
+                    info=cls.get_column_info(c)
+                )
             )
 
+        yield from fields
+
     @classmethod
     def json_metadata(cls):
-        fields = {f.name: f.to_json() for f in cls.iter_metadata_fields()}
-        mapper = inspect(cls)
-        return {
-            'name': cls.__name__,
-            'primaryKeys': [c.key for c in mapper.primary_key],
-            'fields': fields
-        }
+        key = (cls, 'document')
+        document = _metadata.get(key)
+        if document is None:
+            fields = {
+                f.name: f.to_json() for f in cls.iter_metadata_fields()
+            }
+            mapper = inspect(cls)
+            document = _metadata[key] = {
+                'name': cls.__name__,
+                'primaryKeys': [c.key for c in mapper.primary_key],
+                'fields': fields
+            }
+
+        return copy.deepcopy(document)
+
+    @classmethod
+    def get_metadata_response(cls):
+        """Returns the serialized :meth:`json_metadata` and its ETag.
+
+        Both are cached until the mappers are configured again.
+        """
+        key = (cls, 'response')
+        response = _metadata.get(key)
+        if response is None:
+            body = ujson.dumps(cls.json_metadata(), indent=4).encode()
+            response = _metadata[key] = (body, f'"{md5(body).hexdigest()}"')
+
+        return response
 
     def update_from_request(self, strip_value=True):
         for column, value in self.extract_data_from_request(strip_value):
@@ -207,12 +317,54 @@ class BaseModel(object):
                 else:
                     yield c, value
 
+    @classmethod
+    def get_export_plan(cls, **kwargs):
+        """Returns a tuple of `(key, json name, converter)` of the columns
+        which are exported by :meth:`to_dict` using the given options.
+
+        The plans are cached until the mappers are configured again. None is
+        returned if the class overrides how the columns are exported, so
+        they are exported one by one using :meth:`prepare_for_export`.
+        """
+        cache_key = (cls, tuple(sorted(kwargs.items())))
+        try:
+            return _export_plans[cache_key]
+        except KeyError:
+            pass
+
+        plan = None
+        if all(
+            getattr(cls, name).__func__ is getattr(BaseModel, name).__func__
+            for name in _exporting_methods
+        ):
+            plan = []
+            names = set()
+            for c in cls.iter_json_columns(**kwargs):
+                name = cls.get_column_info(c).get('json')
+                if name in names:
+                    continue
+
+                names.add(name)
+                plan.append((c.key, name, compile_converter(c)))
+
+            plan = tuple(plan)
+
+        _export_plans[cache_key] = plan
+        return plan
+
     def to_dict(self, **kwargs):
         result = {}
-        for c in self.iter_json_columns(**kwargs):
-            result.setdefault(
-                *self.prepare_for_export(c, getattr(self, c.key))
-            )
+        plan = self.get_export_plan(**kwargs)
+        if plan is None:
+            for c in self.iter_json_columns(**kwargs):
+                result.setdefault(
+                    *self.prepare_for_export(c, getattr(self, c.key))
+                )
+            return result
+
+        for key, name, convert in plan:
+            result[name] = convert(getattr(self, key))
+
         return result
 
     @classmethod
@@ -243,14 +395,134 @@ class BaseModel(object):
         return query
 
     @classmethod
-    def dump_query(cls, query=None):
-        result = []
-        for o in cls.filter_paginate_sort_query_by_request(query):
-            result.append(o.to_dict())
-        return result
+    def get_projection_plan(cls):
+        """Returns the entries of the :meth:`get_export_plan` which can be
+        selected: the columns, the synonyms of them and the hybrid properties
+        having a SQL expression, or None if the plan is not available.
+
+        A synonym is selected by its target column, so its descriptor is not
+        used, if any.
+        """
+        plan = cls.get_export_plan()
+        if plan is None:
+            return None
+
+        mapper = inspect(cls)
+        descriptors = mapper.all_orm_descriptors
+        projection = []
+        for entry in plan:
+            key = entry[0]
+            if key in mapper.synonyms:
+                key = mapper.synonyms[key].name
+                entry = (key, ) + entry[1:]
+
+            if key in mapper.column_attrs or (
+                key in descriptors
+                and descriptors[key].extension_type is
+                HybridExtensionType.HYBRID_PROPERTY
+                and hasattr(getattr(cls, key), '__clause_element__')
+            ):
+                projection.append(entry)
+
+        return tuple(projection)
+
+    @classmethod
+    def project(cls, query, plan=None):
+        """Returns an iterator of the dictionaries of the query's rows,
+        selecting only the columns of the projection plan instead of loading
+        the instances.
+        """
+        plan = plan or cls.get_projection_plan()
+        keys, names, converters = zip(*plan)
+        rows = query.with_entities(*(getattr(cls, k) for k in keys))
+        return (
+            dict(zip(names, [c(v) for c, v in zip(converters, row)]))
+            for row in rows
+        )
+
+    @classmethod
+    def _iter_dicts(cls, query, projection=False):
+        if projection:
+            plan = cls.get_projection_plan()
+            if plan:
+                return cls.project(query, plan)
+
+        return (o.to_dict() for o in query)
+
+    @classmethod
+    def dump_query(cls, query=None, fast=False):
+        """Dumps the filtered, sorted and paginated query as a list of
+        dictionaries.
+
+        :param fast: Selects only the exported columns and hybrid
+                     properties, skipping the relationships and the other
+                     attributes, see :meth:`get_projection_plan`.
+        """
+        query = cls.filter_paginate_sort_query_by_request(query)
+        return list(cls._iter_dicts(query, fast))
 
     @classmethod
-    def expose(cls, func):
+    def stream_query(cls, query=None, chunk_size=None, projection=False):
+        """Like :meth:`dump_query`, but returns a generator of the JSON
+        array's chunks, in bytes.
+
+        The rows are fetched using `yield_per` and serialized in chunks of
+        `__stream_chunk_size__` rows, so the whole result is never kept in
+        memory. The joined eager loaded collections of the model are loaded
+        using `selectinload` instead. The generator should be returned by an
+        action which does not encode its result, i.e:
+        `@action(content_type='application/json')`, see :meth:`expose`.
+        """
+        chunk_size = chunk_size or cls.__stream_chunk_size__
+        query = cls.filter_paginate_sort_query_by_request(query)
+
+        # The collections eagerly loaded by joins can't be fetched using
+        # `yield_per`, so they are loaded by an extra query per chunk.
+        query = query.options(*(
+            selectinload(getattr(cls, r.key))
+            for r in inspect(cls).relationships
+            if r.lazy == 'joined' and r.uselist
+        ))
+
+        def stream():
+            # Runs the query before the response is started, so the errors
+            # are still reported by the status code
+            rows = cls._iter_dicts(query.yield_per(chunk_size), projection)
+            yield b'['
+
+            separator = b''
+            chunk = []
+            for o in rows:
+                chunk.append(ujson.dumps(o).encode())
+                if len(chunk) >= chunk_size:
+                    yield separator + b','.join(chunk)
+                    separator = b','
+                    chunk = []
+
+            if chunk:
+                yield separator + b','.join(chunk)
+
+            yield b']'
+
+        return stream()
+
+    @classmethod
+    def expose(cls, func=None, stream=False, projection=False):
+        """Dumps the query returned by the decorated action.
+
+        Use `projection=True` to select only the exported columns of the
+        read-only lists, see :meth:`dump_query`.
+
+        Use `@Model.expose(stream=True)` with
+        `@action(content_type='application/json')` instead of `@json`, to
+        stream the result using :meth:`stream_query`.
+        """
+        if func is None:
+            return functools.partial(
+                cls.expose,
+                stream=stream,
+                projection=projection
+            )
 
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
@@ -258,33 +530,46 @@ class BaseModel(object):
             if result is None:
                 raise HTTPNotFound()
             if isinstance(result, Query):
-                return cls.dump_query(result)
+                if stream:
+                    return cls.stream_query(result, projection=projection)
+                return cls.dump_query(result, fast=projection)
+
+            if stream:
+                # Not encoded by the action
+                if hasattr(result, 'to_dict'):
+                    result = result.to_dict()
+                return ujson.dumps(result)
+
             return result
 
         return wrapper
 
     @classmethod
     def create_validation_rules(cls, strict=False, ignore=None):
-        fields = {}
-        for f in cls.iter_metadata_fields():
-            if ignore and f.name in ignore:
-                continue
-
-            fields[f.name] = field = dict(
-                required=f.required,
-                type_=f.type_,
-                minimum=f.minimum,
-                maximum=f.maximum,
-                pattern=f.pattern,
-                min_length=f.min_length,
-                max_length=f.max_length,
-                not_none=f.not_none,
-                readonly=f.readonly
-            )
+        key = (cls, 'rules', bool(strict))
+        rules = _metadata.get(key)
+        if rules is None:
+            rules = _metadata[key] = {}
+            for f in cls.iter_metadata_fields():
+                rules[f.name] = field = dict(
+                    required=f.required,
+                    type_=f.type_,
+                    minimum=f.minimum,
+                    maximum=f.maximum,
+                    pattern=f.pattern,
+                    min_length=f.min_length,
+                    max_length=f.max_length,
+                    not_none=f.not_none,
+                    readonly=f.readonly
+                )
+
+                if not strict and 'required' in field:
+                    del field['required']
 
-            if not strict and 'required' in field:
-                del field['required']
-        return fields
+        return {
+            name: dict(field) for name, field in rules.items()
+            if not (ignore and name in ignore)
+        }
 
     @classmethod
     def validate(cls, strict=False, fields=None, ignore=None):
@@ -0,0 +1,475 @@
+import bisect
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from hashlib import md5
+
+from nanohttp import settings, context as ctx
+from nanohttp.contexts import Context
+
+from .helpers import get_shard_keys, connection_string_redis, \
+    get_connection_string
+from .logging_ import get_logger
+from .orm import create_thread_unsafe_session, create_engine
+
+
+logger = get_logger('sharding')
+
+
+# The shard key used when the database sharding is disabled
+DEFAULT_SHARD_KEY = 'test'
+
+
+def parse_shard_key(key):
+    """Extracts the shard key from its redis key:
+    `sharding:<shard-key>:connection-string`.
+    """
+    if isinstance(key, bytes):
+        key = key.decode()
+
+    return key.replace(':connection-string', '').replace('sharding:', '')
+
+
+class HashRing:
+    """A consistent hash ring to distribute the shards between the hosts.
+
+    Adding or removing a host moves only the shards of its neighbours on
+    the ring.
+    """
+
+    def __init__(self, nodes, replicas=64):
+        self.ring = sorted(
+            (self.hash(f'{node}:{index}'), node)
+            for node in set(nodes)
+            for index in range(replicas)
+        )
+        self.hashes = [hash_ for hash_, _ in self.ring]
+
+    @staticmethod
+    def hash(key):
+        return int.from_bytes(md5(key.encode()).digest()[:8], 'big')
+
+    def get(self, key):
+        if not self.ring:
+            return None
+
+        index = bisect.bisect(self.hashes, self.hash(key)) % len(self.ring)
+        return self.ring[index][1]
+
+
+class ShardDirectory:
+    """Caches the list of the shard keys.
+
+    The list is scanned from the redis at most once per
+    `settings.sharding.refresh_interval` seconds, or as soon as a message
+    is published to the `settings.sharding.notification_channel`, see
+    :func:`notify_shards_changed`.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.refresh_interval = settings.sharding.refresh_interval
+        self.channel = settings.sharding.notification_channel
+        self.host = settings.sharding.host or socket.gethostname()
+        self.hosts = settings.sharding.hosts or [self.host]
+        self.ring = HashRing(self.hosts)
+        self.listeners = []
+        self.subscriber = None
+        self._keys = None
+        self.refreshed_at = None
+
+    def add_listener(self, callback):
+        """Registers `callback(added, removed)` to be called when the shards
+        are changed.
+        """
+        self.listeners.append(callback)
+
+    def invalidate(self):
+        with self.lock:
+            self.refreshed_at = None
+
+    def keys(self):
+        if not settings.is_database_sharding:
+            return [DEFAULT_SHARD_KEY]
+
+        if self.channel and self.subscriber is None:
+            self.subscribe()
+
+        with self.lock:
+            previous = self._keys
+            if self.refreshed_at is None or \
+                    time.monotonic() - self.refreshed_at >= \
+                    self.refresh_interval:
+                self._keys = sorted(
+                    parse_shard_key(k) for k in get_shard_keys()
+                )
+                self.refreshed_at = time.monotonic()
+
+            keys = self._keys
+
+        if previous is not None and keys != previous:
+            added = set(keys) - set(previous)
+            removed = set(previous) - set(keys)
+            for callback in self.listeners:
+                callback(added, removed)
+
+        return list(keys)
+
+    def check_host(self):
+        """Raises :exc:`ValueError` if this host is not one of the
+        `settings.sharding.hosts`, so it would own none of the shards.
+        """
+        if self.host not in self.hosts:
+            raise ValueError(
+                f'The host {self.host} is not in the sharding.hosts, '
+                f'set the sharding.host setting to one of them'
+            )
+
+    def owned_keys(self):
+        """The shards which this host is responsible for."""
+        return [k for k in self.keys() if self.ring.get(k) == self.host]
+
+    def subscribe(self):
+        self.subscriber = threading.Thread(
+            target=self._listen,
+            name='shard-directory',
+            daemon=True,
+        )
+        self.subscriber.start()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = connection_string_redis().pubsub(
+                    ignore_subscribe_messages=True
+                )
+                pubsub.subscribe(self.channel)
+                for _ in pubsub.listen():
+                    self.invalidate()
+
+            except Exception as exp:
+                logger.error(exp, exc_info=True)
+                self.invalidate()
+                time.sleep(self.refresh_interval)
+
+
+def notify_shards_changed():
+    """Tells the workers to scan the shards again, should be called after
+    adding or removing a shard.
+    """
+    connection_string_redis().publish(
+        settings.sharding.notification_channel,
+        'changed'
+    )
+
+
+_directory = None
+_directory_pid = None
+_directory_lock = threading.Lock()
+
+
+def get_shard_directory() -> ShardDirectory:
+    global _directory, _directory_pid
+
+    with _directory_lock:
+        if _directory is None or _directory_pid != os.getpid():
+            _directory = ShardDirectory()
+            _directory_pid = os.getpid()
+
+        return _directory
+
+
+class ShardEngine:
+    def __init__(self, url, engine):
+        self.url = url
+        self.engine = engine
+        self.used_at = self.checked_at = time.monotonic()
+
+    @property
+    def busy(self):
+        checkedout = getattr(self.engine.pool, 'checkedout', None)
+        return checkedout is not None and checkedout() > 0
+
+
+class ShardEngineRegistry:
+    """Creates an engine with a small connection pool for each shard,
+    lazily.
+
+    The connection string of a shard is read from the redis when its
+    engine is created, and checked again every
+    `settings.sharding.engines.refresh_interval` seconds; the engine is
+    replaced when it is changed.
+
+    At most `max_engines` engines are kept, the least recently used idle
+    ones are disposed first. The engines which have not been used for
+    `idle_timeout` seconds are disposed as well.
+    """
+
+    def __init__(self, max_engines=None, pool_size=None, max_overflow=None,
+                 idle_timeout=None, refresh_interval=None):
+        config = settings.sharding.engines
+        self.max_engines = max_engines or config.max_engines
+        self.pool_size = pool_size or config.pool_size
+        self.max_overflow = config.max_overflow \
+            if max_overflow is None else max_overflow
+        self.idle_timeout = idle_timeout or config.idle_timeout
+        self.refresh_interval = refresh_interval or config.refresh_interval
+        self.engines = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.engines)
+
+    def __contains__(self, shard_key):
+        return shard_key in self.engines
+
+    def create_engine(self, url):
+        return create_engine(
+            url,
+            pool_size=self.pool_size,
+            max_overflow=self.max_overflow,
+            pool_pre_ping=True,
+        )
+
+    def get_connection_string(self, shard_key):
+        return get_connection_string(shard_key)
+
+    def get(self, shard_key):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.engines.get(shard_key)
+            if entry is not None:
+                self.engines.move_to_end(shard_key)
+                entry.used_at = now
+                if now - entry.checked_at < self.refresh_interval:
+                    return entry.engine
+
+        url = self.get_connection_string(shard_key)
+        disposed = []
+        with self.lock:
+            entry = self.engines.get(shard_key)
+            if entry is not None and entry.url != url:
+                disposed.append(self.engines.pop(shard_key))
+                entry = None
+
+            if entry is None:
+                entry = self.engines[shard_key] = ShardEngine(
+                    url,
+                    self.create_engine(url)
+                )
+
+            entry.checked_at = entry.used_at = now
+            self.engines.move_to_end(shard_key)
+            disposed.extend(self._evict(now, shard_key))
+
+        for old in disposed:
+            old.engine.dispose()
+
+        return entry.engine
+
+    def _evict(self, now, keep):
+        evicted = []
+        for shard_key, entry in list(self.engines.items()):
+            if shard_key == keep:
+                continue
+
+            overflow = len(self.engines) > self.max_engines
+            idle = now - entry.used_at >= self.idle_timeout
+            if not (overflow or idle):
+                break
+
+            if not entry.busy:
+                evicted.append(self.engines.pop(shard_key))
+
+        return evicted
+
+    def invalidate(self, shard_key):
+        """Disposes the engine of the shard, the next :meth:`get` creates
+        a new one.
+        """
+        with self.lock:
+            entry = self.engines.pop(shard_key, None)
+
+        if entry is not None:
+            entry.engine.dispose()
+
+    def dispose(self):
+        with self.lock:
+            entries = list(self.engines.values())
+            self.engines.clear()
+
+        for entry in entries:
+            entry.engine.dispose()
+
+
+_registry = None
+_registry_pid = None
+
+
+def get_shard_engine_registry() -> ShardEngineRegistry:
+    """Returns the engine registry of the current process.
+
+    The engines of the shards which are removed from the
+    :class:`ShardDirectory` are disposed.
+    """
+    global _registry, _registry_pid
+
+    with _directory_lock:
+        if _registry is not None and _registry_pid == os.getpid():
+            return _registry
+
+        _registry = ShardEngineRegistry()
+        _registry_pid = os.getpid()
+
+    registry = _registry
+
+    def on_change(added, removed):
+        for shard_key in removed:
+            registry.invalidate(shard_key)
+
+    get_shard_directory().add_listener(on_change)
+    return registry
+
+
+def _run_on_shard(func, shard_key, session):
+    with Context({}):
+        ctx.shard_key = shard_key
+        try:
+            return func(shard_key, session)
+        except Exception:
+            session.rollback()
+            raise
+
+
+class ShardScheduler:
+    """Runs `func(shard_key, session)` repeatedly for each shard owned by
+    this host, on a pool of threads.
+
+    A shard is never run by two threads at once, so a slow shard holds a
+    single thread and the others are not delayed. The shard is run again
+    as soon as `func` returns a truthy value, i.e: it has found some work,
+    otherwise after `interval` seconds.
+
+    Each shard has a session which is kept between the runs and is closed
+    when the shard is removed.
+    """
+
+    def __init__(self, func, size=None, interval=None, directory=None,
+                 name='shard'):
+        self.func = func
+        self.size = size or settings.sharding.threads
+        self.interval = interval or settings.sharding.interval
+        if directory is None:
+            directory = get_shard_directory()
+            directory.check_host()
+
+        self.directory = directory
+        self.name = name
+        self.sessions = {}
+
+    def run(self, stop=None):
+        running = {}
+        due = {}
+        executor = ThreadPoolExecutor(
+            self.size,
+            thread_name_prefix=self.name
+        )
+        try:
+            while stop is None or not stop.is_set():
+                keys = self.directory.owned_keys()
+                now = time.monotonic()
+                for shard_key in keys:
+                    if shard_key in running or due.get(shard_key, 0) > now:
+                        continue
+
+                    session = self.sessions.get(shard_key)
+                    if session is None:
+                        session = self.sessions[shard_key] = \
+                            create_thread_unsafe_session()
+
+                    running[shard_key] = executor.submit(
+                        _run_on_shard,
+                        self.func,
+                        shard_key,
+                        session,
+                    )
+
+                for shard_key in set(self.sessions) - set(keys) - \
+                        set(running):
+                    self.sessions.pop(shard_key).close()
+                    due.pop(shard_key, None)
+
+                waiting = [d - now for k, d in due.items() if k in keys
+                           and k not in running]
+                timeout = max(0, min(waiting + [self.interval]))
+                if running:
+                    wait(
+                        running.values(),
+                        timeout=timeout,
+                        return_when=FIRST_COMPLETED
+                    )
+                elif stop is not None:
+                    stop.wait(timeout)
+                else:
+                    time.sleep(timeout)
+
+                for shard_key, future in list(running.items()):
+                    if not future.done():
+                        continue
+
+                    del running[shard_key]
+                    busy = False
+                    try:
+                        busy = future.result()
+                    except Exception as exp:
+                        logger.error(f'Error when running shard: {shard_key}')
+                        logger.error(exp, exc_info=True)
+
+                    due[shard_key] = time.monotonic() + \
+                        (0 if busy else self.interval)
+
+        finally:
+            executor.shutdown(wait=True)
+            for session in self.sessions.values():
+                session.close()
+
+            self.sessions.clear()
+
+
+def for_each_shard(func, session=None, size=None, directory=None):
+    """Runs `func(shard_key, session)` once for each shard.
+
+    When the database sharding is disabled, the `func` is called in the
+    current thread using the given `session`. Otherwise the shards are run
+    in parallel with a new session each, the errors are logged and the
+    failed shards are left out of the result.
+
+    :return: A dictionary of the shard keys and the results.
+    """
+    directory = directory or get_shard_directory()
+    if not settings.is_database_sharding:
+        ctx.shard_key = DEFAULT_SHARD_KEY
+        return {DEFAULT_SHARD_KEY: func(DEFAULT_SHARD_KEY, session)}
+
+    def run(shard_key):
+        shard_session = create_thread_unsafe_session()
+        try:
+            return _run_on_shard(func, shard_key, shard_session)
+        finally:
+            shard_session.close()
+
+    results = {}
+    keys = directory.keys()
+    with ThreadPoolExecutor(size or settings.sharding.threads) as executor:
+        futures = {k: executor.submit(run, k) for k in keys}
+        for shard_key, future in futures.items():
+            try:
+                results[shard_key] = future.result()
+            except Exception as exp:
+                logger.error(f'Error when running shard: {shard_key}')
+                logger.error(exp, exc_info=True)
+
+    return results
@@ -0,0 +1,132 @@
+import multiprocessing
+import os
+import signal
+import threading
+import time
+
+from .logging_ import get_logger
+
+
+logger = get_logger('supervisor')
+
+
+class Supervisor:
+    """Runs a pool of workers and restarts them when they crash.
+
+    Workers are threads or forked processes running the `target` callable
+    with a `stop` event keyword argument. On `SIGINT` or `SIGTERM` the event
+    is set and workers are given `drain_timeout` seconds to finish their
+    current task before the process exits by the same signal.
+
+    A crashed worker is restarted after `restart_delay` seconds, doubled on
+    each consecutive crash up to `max_restart_delay`. So a worker which dies
+    at startup does not spin. The delay is reset when the worker has been
+    running for `max_restart_delay` seconds.
+    """
+
+    def __init__(self, target, number_of_workers=1, fork=False,
+                 initializer=None, drain_timeout=30, check_interval=1,
+                 restart_delay=1, max_restart_delay=60, **kwargs):
+        self.target = target
+        self.number_of_workers = number_of_workers
+        self.fork = fork
+        self.initializer = initializer
+        self.drain_timeout = drain_timeout
+        self.check_interval = check_interval
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.kwargs = kwargs
+        self.signal_number = None
+        self.workers = []
+        self.started_at = {}
+        self.crashes = {}
+        self.restart_at = {}
+
+        if fork:
+            multiprocessing_context = multiprocessing.get_context('fork')
+            self.stop = multiprocessing_context.Event()
+            self.worker_factory = multiprocessing_context.Process
+        else:
+            self.stop = threading.Event()
+            self.worker_factory = threading.Thread
+
+    def _run_worker(self):
+        if self.initializer is not None:
+            self.initializer()
+
+        self.target(stop=self.stop, **self.kwargs)
+
+    def spawn(self, index):
+        worker = self.worker_factory(
+            target=self._run_worker,
+            name=f'worker-{index}',
+            daemon=True,
+        )
+        worker.start()
+        self.started_at[index] = time.monotonic()
+        return worker
+
+    def signal_handler(self, signal_number, frame):
+        if self.signal_number is not None:
+            # Second signal, Do not wait for the workers anymore.
+            signal.signal(signal_number, signal.SIG_DFL)
+            os.kill(os.getpid(), signal_number)
+            return
+
+        self.signal_number = signal_number
+
+    def run(self):
+        signal.signal(signal.SIGINT, self.signal_handler)
+        signal.signal(signal.SIGTERM, self.signal_handler)
+
+        self.start()
+        self.watch()
+        self.stop.set()
+        self.drain()
+
+        # Terminating the process by the received signal, as it would be
+        # without any handler.
+        signal.signal(self.signal_number, signal.SIG_DFL)
+        os.kill(os.getpid(), self.signal_number)
+
+    def start(self):
+        self.workers = [self.spawn(i) for i in range(self.number_of_workers)]
+
+    def watch(self):
+        while self.signal_number is None:
+            time.sleep(self.check_interval)
+            for index, worker in enumerate(self.workers):
+                if self.signal_number is not None or worker.is_alive():
+                    continue
+
+                now = time.monotonic()
+                if index not in self.restart_at:
+                    crashes = 1
+                    if now - self.started_at[index] < self.max_restart_delay:
+                        crashes += self.crashes.get(index, 0)
+
+                    self.crashes[index] = crashes
+                    delay = min(
+                        self.restart_delay * 2 ** (crashes - 1),
+                        self.max_restart_delay
+                    )
+                    logger.error(
+                        f'Worker {worker.name} is died, restarting in '
+                        f'{delay:.1f} seconds'
+                    )
+                    self.restart_at[index] = now + delay
+
+                elif now >= self.restart_at[index]:
+                    del self.restart_at[index]
+                    self.workers[index] = self.spawn(index)
+
+    def drain(self):
+        deadline = time.monotonic() + self.drain_timeout
+        for worker in self.workers:
+            worker.join(max(deadline - time.monotonic(), 0))
+            if not worker.is_alive():
+                continue
+
+            logger.error(f'Worker {worker.name} is not stopped in time')
+            if self.fork:
+                worker.terminate()
@@ -1,22 +1,41 @@
+import asyncio
+import functools
+import random
+import re
+import threading
 import time
 import traceback
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from itertools import groupby, islice
 
 from nanohttp import settings
-from sqlalchemy import Integer, Enum, Unicode, DateTime
+from sqlalchemy import Integer, Enum, Unicode, DateTime, Float, Index, \
+    select, inspect, or_, and_, func, true, values as sa_values, \
+    column as sa_column
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.event import listen
 from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import with_polymorphic, object_session, \
+    SynonymProperty
 from sqlalchemy.sql.expression import text
 
 from .constants import RESTFULPY_TASK_NEW, RESTFULPY_TASK_SUCCESS, \
     RESTFULPY_TASK_IN_PROGRESS, RESTFULPY_TASK_FAILED
-from .helpers import get_shard_keys, with_context
+from .db import PostgreSQLListener, notify, notify_on_flush
+from .helpers import with_context
+from .lease import renew_expired_leases, get_lease_values, start_heartbeat, \
+    stop_heartbeat
 from .logging_ import get_logger
+from .metrics import get_metrics_sink, report_task
 from .exceptions import RestfulException
 from .orm import TimestampMixin, DeclarativeBase, Field, DBSession, \
-    create_thread_unsafe_session
+    create_thread_unsafe_session, metadata
+from .sharding import for_each_shard
 
 
 logger = get_logger('taskqueue')
+PENDING_STATUSES = (RESTFULPY_TASK_NEW, RESTFULPY_TASK_IN_PROGRESS)
 
 
 class TaskPopError(RestfulException):
@@ -27,11 +46,39 @@ class MaxRetriesExceededError(RestfulException):
     pass
 
 
+class TaskTimeoutError(RestfulException):
+    pass
+
+
 class RestfulpyTask(TimestampMixin, DeclarativeBase):
     __tablename__ = 'restfulpy_task'
 
     __max_retries__ = None  # set to None to not apply max_reties on the tasks.
 
+    # Seconds to postpone the first retry of a failed task, doubled for each
+    # next retry up to `__retry_backoff_max__`. Set to None to retry the
+    # failed tasks immediately.
+    __retry_backoff__ = None
+    __retry_backoff_max__ = 3600
+    # Adds a random delay up to this fraction of the backoff, to prevent the
+    # tasks failed together from being retried together.
+    __retry_jitter__ = .1
+
+    # Maximum number of the tasks of this type running at the same time by
+    # all of the workers, None for no limit.
+    __concurrency__ = None
+    # Share of this type when popping the tasks of several types, i.e. a type
+    # with weight 2 gets twice the tasks of a type with weight 1. Leave the
+    # weight and concurrency of all types as None to pop the tasks only by
+    # their priority.
+    __weight__ = None
+
+    # Seconds, the task is failed if its `do_` is not returned in this
+    # period. The `do_` is then run by a separate thread which gets
+    # `context['cancelled']`, an event that is set on timeout, to give up
+    # cooperatively. None for no timeout.
+    __timeout__ = None
+
     id = Field(
         Integer,
         primary_key=True,
@@ -73,6 +120,26 @@ class RestfulpyTask(TimestampMixin, DeclarativeBase):
         nullable=False,
         default=0,
     )
+    worker_id = Field(
+        Unicode(128),
+        nullable=True,
+    )
+    lease_expires_at = Field(
+        DateTime(timezone=True),
+        nullable=True,
+    )
+    run_after = Field(
+        DateTime(timezone=True),
+        nullable=True,
+        json='runAfter',
+    )
+    # At most one new or in-progress task of each type may have the same
+    # key, see :meth:`enqueue_many`.
+    dedup_key = Field(
+        Unicode(256),
+        nullable=True,
+        json='dedupKey',
+    )
 
     __mapper_args__ = {
         'polymorphic_identity': __tablename__,
@@ -80,97 +147,771 @@ class RestfulpyTask(TimestampMixin, DeclarativeBase):
     }
 
     def do_(self, context):
+        if type(self).do_async is RestfulpyTask.do_async:
+            raise NotImplementedError
+
+        asyncio.run(self.do_async(context))
+
+    async def do_async(self, context):
+        """Override this instead of :meth:`do_` for the I/O bound tasks,
+        to run them concurrently by the :func:`async_worker`.
+
+        The changes made to the task's attributes are not stored.
+        """
         raise NotImplementedError
 
+    @classmethod
+    def get_async_types(cls):
+        """Returns the polymorphic identities of the types which are
+        implementing :meth:`do_async`.
+        """
+        return [
+            mapper.polymorphic_identity
+            for mapper in inspect(cls).self_and_descendants
+            if mapper.polymorphic_identity is not None
+            and mapper.class_.do_async is not RestfulpyTask.do_async
+        ]
+
+    def get_retry_delay(self):
+        """Returns the seconds to wait before retrying this failed task or
+        `None` to retry it immediately.
+        """
+        if not self.__retry_backoff__:
+            return None
+
+        delay = min(
+            self.__retry_backoff__ * 2 ** max(self.retries - 1, 0),
+            self.__retry_backoff_max__,
+        )
+        return delay + random.uniform(0, delay * self.__retry_jitter__)
+
+    @classmethod
+    def __declare_last__(cls):
+        notify_on_flush(cls, lambda: settings.worker.notification_channel)
+
+    @classmethod
+    def enqueue(cls, session=DBSession, on_conflict=None, **values):
+        """Inserts a task using :meth:`enqueue_many`.
+
+        :return: The id of the inserted or replaced task, `None` if it's
+                 ignored.
+        """
+        ids = cls.enqueue_many([values], session, on_conflict=on_conflict)
+        return ids[0] if ids else None
+
+    @classmethod
+    def enqueue_many(cls, rows, session=DBSession, batch_size=None,
+                     on_conflict=None):
+        """Inserts the tasks of this type in bulk, without the ORM.
+
+        Each row is a dictionary of the attribute values of one task, the
+        omitted ones get their column's default. The ids are allocated from
+        the sequence up front, so each table of the hierarchy gets a plain
+        multi-row insert per batch, instead of one insert per row and table.
+
+        The session is not committed.
+
+        :param rows: An iterable of dictionaries, consumed batch by batch.
+        :param on_conflict: What to do with a row whose `dedup_key` belongs
+                            to a new or in-progress task of this type.
+                            `ignore` skips the row and `replace` overwrites
+                            the task with the row's values if it's not
+                            started yet. `None` raises the unique violation
+                            error.
+        :return: The ids of the inserted (or replaced) tasks.
+        """
+        if on_conflict not in (None, 'ignore', 'replace'):
+            raise ValueError(f'Invalid on_conflict: {on_conflict}')
+
+        if on_conflict and settings.worker.partitioning.enabled:
+            raise ValueError(
+                'The deduplication is not supported by the partitioned tables'
+            )
+
+        batch_size = batch_size or settings.worker.enqueue_batch_size
+        mapper = inspect(cls)
+        tables = []
+        for m in reversed(list(mapper.iterate_to_root())):
+            if m.local_table not in tables:
+                tables.append(m.local_table)
+
+        discriminator = mapper.polymorphic_on
+        columns = {}
+
+        def get_columns(key):
+            if key not in columns:
+                prop = mapper.get_property(key)
+                if isinstance(prop, SynonymProperty):
+                    prop = mapper.get_property(prop.name)
+
+                columns[key] = prop.columns
+
+            return columns[key]
+
+        sequence = text(
+            'SELECT nextval(pg_get_serial_sequence(:table, \'id\')) '
+            'FROM generate_series(1, :count)'
+        )
+        rows = iter(rows)
+        ids = []
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+
+            if on_conflict == 'replace':
+                # A statement can't update a row twice, so only the last row
+                # of each key is kept.
+                last = {r.get('dedup_key'): r for r in batch}
+                batch = [
+                    r for r in batch
+                    if r.get('dedup_key') is None or last[r['dedup_key']] is r
+                ]
+
+            batch_ids = session.execute(
+                sequence,
+                dict(table=RestfulpyTask.__tablename__, count=len(batch))
+            ).scalars().all()
+
+            params = {table: [] for table in tables}
+            for task_id, row in zip(batch_ids, batch):
+                values = {table: dict(id=task_id) for table in tables}
+                values[discriminator.table][discriminator.key] = \
+                    mapper.polymorphic_identity
+                for key, value in row.items():
+                    for column in get_columns(key):
+                        values[column.table][column.key] = value
+
+                for table in tables:
+                    params[table].append(values[table])
+
+            if on_conflict is None:
+                for table in tables:
+                    for group in _group_by_keys(params[table]):
+                        session.execute(table.insert(), group)
+
+                ids.extend(batch_ids)
+                continue
+
+            task_ids = _insert_deduplicated(
+                tables[0],
+                params[tables[0]],
+                on_conflict,
+                session,
+            )
+            for table in tables[1:]:
+                rows_ = [
+                    dict(r, id=task_ids[r['id']])
+                    for r in params[table] if r['id'] in task_ids
+                ]
+                for group in _group_by_keys(rows_):
+                    statement = insert(table).values(group)
+                    set_ = {
+                        k: statement.excluded[k] for k in group[0] if k != 'id'
+                    }
+                    if on_conflict == 'replace' and set_:
+                        statement = statement.on_conflict_do_update(
+                            index_elements=[table.c.id],
+                            set_=set_,
+                        )
+                    elif on_conflict == 'replace':
+                        statement = statement.on_conflict_do_nothing(
+                            index_elements=[table.c.id],
+                        )
+                    session.execute(statement)
+
+            ids.extend(task_ids[i] for i in batch_ids if i in task_ids)
+
+        if ids and settings.worker.notification_channel:
+            notify(session, settings.worker.notification_channel)
+
+        return ids
+
     @classmethod
     def pop(
             cls,
             statuses={RESTFULPY_TASK_NEW},
             filters=None,
             session=DBSession,
+            worker_id=None,
     ):
+        tasks = cls.pop_many(
+            1,
+            statuses=statuses,
+            filters=filters,
+            session=session,
+            worker_id=worker_id,
+        )
+        if not tasks:
+            raise TaskPopError('There is no task to pop')
 
-        find_query = session.query(
-            cls.id.label('id'),
-            cls.created_at,
-            cls.status,
-            cls.type,
-            cls.priority
+        return tasks[0]
+
+    @classmethod
+    def pop_many(
+            cls,
+            size,
+            statuses={RESTFULPY_TASK_NEW},
+            filters=None,
+            session=DBSession,
+            worker_id=None,
+    ):
+        """Claims up to `size` tasks using a single `UPDATE ... RETURNING`.
+
+        Rows locked by the other workers are skipped instead of waiting for
+        them, and all of the claimed tasks are loaded with their subclass
+        columns using one polymorphic query.
+
+        When the `worker_id` is given, the tasks are leased to the worker
+        for `settings.lease.duration` seconds.
+
+        The tasks which are postponed by `run_after` are not popped until
+        then.
+
+        If any task type declares `__weight__` or `__concurrency__`, the
+        types are scheduled fairly, see :meth:`_find_fair`.
+        """
+
+        policies = cls.get_scheduling_policies()
+        if any(w is not None or c is not None for w, c in policies.values()):
+            find_query = cls._find_fair(
+                size,
+                policies,
+                statuses,
+                filters,
+                session,
+            )
+            if find_query is None:
+                session.commit()
+                return []
+
+        else:
+            find_query = cls._find_query(statuses, filters, session) \
+                .with_entities(cls.id.label('id')) \
+                .order_by(cls.priority.desc()) \
+                .order_by(cls.created_at) \
+                .limit(size) \
+                .with_for_update(skip_locked=True) \
+                .subquery('find_query')
+
+        values = dict(
+            status=RESTFULPY_TASK_IN_PROGRESS,
+            started_at=datetime.utcnow(),
+            retries=RestfulpyTask.retries + 1,
         )
+        values.update(get_lease_values(worker_id))
+
+        update_query = RestfulpyTask.__table__.update() \
+            .where(RestfulpyTask.id == find_query.c.id) \
+            .values(**values) \
+            .returning(RestfulpyTask.__table__.c.id)
+
+        task_ids = [row[0] for row in session.execute(update_query)]
+        session.commit()
+        if not task_ids:
+            return []
+
+        polymorphic_task = with_polymorphic(cls, '*')
+        return session.query(polymorphic_task) \
+            .filter(polymorphic_task.id.in_(task_ids)) \
+            .order_by(polymorphic_task.priority.desc()) \
+            .order_by(polymorphic_task.created_at) \
+            .populate_existing() \
+            .all()
+
+    @classmethod
+    def _find_query(cls, statuses, filters, session):
+        query = session.query(cls)
         if filters is not None:
-            find_query = find_query.filter(
+            query = query.filter(
                 text(filters) if isinstance(filters, str) else filters
             )
 
-        find_query = find_query \
+        return query \
             .filter(cls.status.in_(statuses)) \
+            .filter(or_(
+                cls.run_after.is_(None),
+                cls.run_after <= datetime.utcnow()
+            ))
+
+    @classmethod
+    def get_scheduling_policies(cls):
+        """Returns the `(__weight__, __concurrency__)` of all task types in
+        the hierarchy by their polymorphic identity.
+        """
+        return {
+            mapper.polymorphic_identity: (
+                mapper.class_.__weight__,
+                mapper.class_.__concurrency__,
+            )
+            for mapper in inspect(cls).self_and_descendants
+            if mapper.polymorphic_identity is not None
+        }
+
+    @classmethod
+    def _find_fair(cls, size, policies, statuses, filters, session):
+        """Selects the ids of up to `size` tasks using weighted fair queueing.
+
+        Up to `size` candidates of each type are locked, ranked within their
+        type by priority and ordered by their virtual time:
+        `(running + rank) / weight`, where `running` is the number of the
+        tasks of the type which are in progress. So each type gets its
+        weighted share across the pops, even one task at a time, and a
+        flood of one type doesn't starve the others.
+
+        The remaining slots of the types with a `__concurrency__` are
+        counted while holding a transaction level advisory lock of each
+        type. So the limit holds for many workers. A type whose lock is held
+        by another worker is skipped in this round, like the locked rows.
+        """
+        table = RestfulpyTask.__table__
+        budgets = dict.fromkeys(policies, size)
+        limited = sorted(t for t, (_, c) in policies.items() if c is not None)
+        acquired = ()
+        if limited:
+            acquired = session.execute(select(*(
+                func.pg_try_advisory_xact_lock(
+                    func.hashtext(f'{table.name}:{t}')
+                ) for t in limited
+            ))).one()
+
+        running = dict(session.execute(
+            select(table.c.type, func.count())
+            .where(table.c.status == RESTFULPY_TASK_IN_PROGRESS)
+            .where(table.c.type.in_(policies))
+            .group_by(table.c.type)
+        ).all())
+
+        for type_, locked in zip(limited, acquired):
+            concurrency = policies[type_][1]
+            budgets[type_] = min(
+                size,
+                concurrency - running.get(type_, 0)
+            ) if locked else 0
+
+        types = [
+            (
+                type_,
+                float(policies[type_][0] or 1),
+                budget,
+                running.get(type_, 0),
+            )
+            for type_, budget in budgets.items() if budget > 0
+        ]
+        if not types:
+            return None
+
+        types = sa_values(
+            sa_column('type', Unicode),
+            sa_column('weight', Float),
+            sa_column('budget', Integer),
+            sa_column('running', Integer),
+            name='task_types'
+        ).data(types)
+
+        candidates = cls._find_query(statuses, filters, session) \
+            .with_entities(cls.id, cls.type, cls.priority, cls.created_at) \
+            .filter(cls.type == types.c.type) \
             .order_by(cls.priority.desc()) \
             .order_by(cls.created_at) \
-            .limit(1) \
-            .with_for_update()
+            .limit(size) \
+            .with_for_update(skip_locked=True) \
+            .subquery() \
+            .lateral('candidates')
 
-        cte = find_query.cte('find_query')
+        rank = func.row_number().over(
+            partition_by=candidates.c.type,
+            order_by=(candidates.c.priority.desc(), candidates.c.created_at)
+        )
+        ranked = select(
+            candidates.c.id,
+            candidates.c.priority,
+            candidates.c.created_at,
+            rank.label('rank'),
+            ((types.c.running + rank) / types.c.weight)
+            .label('virtual_time'),
+            types.c.budget,
+        ) \
+            .select_from(types.join(candidates, true())) \
+            .subquery('ranked')
 
-        update_query = RestfulpyTask.__table__.update() \
-            .where(RestfulpyTask.id == cte.c.id) \
-            .values(
-                status=RESTFULPY_TASK_IN_PROGRESS,
-                started_at=datetime.utcnow(),
-                retries=RestfulpyTask.retries + 1,
+        return select(ranked.c.id) \
+            .where(ranked.c.rank <= ranked.c.budget) \
+            .order_by(
+                ranked.c.virtual_time,
+                ranked.c.priority.desc(),
+                ranked.c.created_at,
             ) \
-            .returning(RestfulpyTask.__table__.c.id)
+            .limit(size) \
+            .subquery('find_query')
 
-        task_id = session.execute(update_query).fetchone()
-        session.commit()
-        if not task_id:
-            raise TaskPopError('There is no task to pop')
-        task_id = task_id[0]
-        task = session.query(cls).filter(cls.id == task_id).one()
-        return task
+    @classmethod
+    def get_stats(cls, statuses=PENDING_STATUSES, session=DBSession):
+        """Returns the number of the tasks and the age of the oldest one in
+        seconds, grouped by status, type and priority.
+
+        The default statuses are covered by the partial indexes, pass
+        `None` to include the finished tasks too.
+        """
+        query = session.query(
+            cls.status,
+            cls.type,
+            cls.priority,
+            func.count(),
+            func.extract('epoch', func.now() - func.min(cls.created_at)),
+        )
+        if statuses is not None:
+            query = query.filter(cls.status.in_(statuses))
+
+        return query \
+            .group_by(cls.status, cls.type, cls.priority) \
+            .order_by(cls.status, cls.type, cls.priority.desc()) \
+            .all()
+
+    @classmethod
+    def next_run_after(cls, statuses={RESTFULPY_TASK_NEW}, filters=None,
+                       session=DBSession):
+        """Returns the time of the earliest postponed task, if any."""
+        query = session.query(func.min(cls.run_after)) \
+            .filter(cls.status.in_(statuses)) \
+            .filter(cls.run_after > datetime.utcnow())
+
+        if filters is not None:
+            query = query.filter(
+                text(filters) if isinstance(filters, str) else filters
+            )
+
+        return query.scalar()
+
+    def execute(self, context, session=None):
+        """Runs the task and marks it as succeeded.
+
+        The task is executed as is, so the session should be the one that
+        has loaded the task, which is the default. The changes made by the
+        task and its new status are committed together, by a single
+        UPDATE statement. The changes made through the :data:`DBSession`
+        are committed just before that, and the :data:`DBSession` is
+        removed afterwards.
+
+        On :exc:`TaskTimeoutError` the task may be still running, so the
+        connection of the session is invalidated and the session should
+        not be used anymore.
+        """
+        session = session or object_session(self)
+        if session is DBSession:
+            session = DBSession()
 
-    def execute(self, context, session=DBSession):
         try:
-            isolated_task = session \
-                .query(RestfulpyTask) \
-                .filter(RestfulpyTask.id == self.id) \
-                .one()
-            if isolated_task.__max_retries__ is not None and \
-                    isolated_task.retries >= isolated_task.__max_retries__:
+            if self.__max_retries__ is not None and \
+                    self.retries >= self.__max_retries__:
                 raise MaxRetriesExceededError()
 
-            isolated_task.do_(context)
+            if self.__timeout__ is None:
+                self._do(context, session)
+            else:
+                self._do_with_timeout(context, session)
+
+            self.status = RESTFULPY_TASK_SUCCESS
+            self.terminated_at = datetime.utcnow()
             session.commit()
+        except TaskTimeoutError:
+            raise
         except:
             session.rollback()
             raise
 
+    def _do(self, context, session):
+        try:
+            self.do_(context)
+            if DBSession.registry.has() and DBSession() is not session:
+                DBSession.commit()
+
+        finally:
+            if DBSession.registry.has() and DBSession() is not session:
+                DBSession.remove()
+
+    def _do_with_timeout(self, context, session):
+        cancelled = threading.Event()
+        context = dict(context, cancelled=cancelled)
+        error = []
+        lock = threading.Lock()
+
+        @with_context
+        def target():
+            try:
+                self._do(context, session)
+            except BaseException as exp:
+                error.append(exp)
+            finally:
+                with lock:
+                    if cancelled.is_set():
+                        # Abandoned, the connections which are checked out
+                        # after the timeout are given back here.
+                        session.close()
+
+        # Not to leave the connection idle in transaction if the task hangs
+        session.commit()
+        thread = threading.Thread(
+            target=target,
+            name=f'task-{self.id}',
+            daemon=True,
+        )
+        thread.start()
+        thread.join(self.__timeout__)
+        with lock:
+            if thread.is_alive():
+                cancelled.set()
+                session.invalidate()
+
+        if cancelled.is_set():
+            raise TaskTimeoutError(
+                f'Task {self.id} is timed out after {self.__timeout__} '
+                f'seconds.'
+            )
+
+        if error:
+            raise error[0]
+
+    async def _do_async_with_timeout(self, context):
+        # Unlike asyncio.wait_for, a TimeoutError raised by the task itself
+        # is not taken as the expiry of the task's timeout.
+        job = asyncio.ensure_future(self.do_async(context))
+        try:
+            done, _ = await asyncio.wait({job}, timeout=self.__timeout__)
+        except asyncio.CancelledError:
+            job.cancel()
+            raise
+
+        if not done:
+            job.cancel()
+            await asyncio.wait({job})
+            raise TaskTimeoutError(
+                f'Task {self.id} is timed out after {self.__timeout__} '
+                f'seconds.'
+            )
+
+        return job.result()
+
+    @classmethod
+    def iter_tables(cls):
+        """Yields the tables of the whole polymorphic hierarchy.
+
+        The tables of the subclasses come before their base's, so it's safe
+        to delete rows in this order.
+        """
+        tables = {}
+        for mapper in inspect(cls).self_and_descendants:
+            if mapper.inherits is not None \
+                    and mapper.local_table is mapper.inherits.local_table:
+                continue
+
+            tables[mapper.local_table] = len(list(mapper.iterate_to_root()))
+
+        yield from sorted(tables, key=tables.get, reverse=True)
+
     @classmethod
     @with_context
-    def cleanup(cls, time_limitation, session=DBSession):
-        shard_keys = [b'sharding:test:connection-string']
-        if settings.is_database_sharding:
-            shard_keys = get_shard_keys()
-
-        for shard_key in shard_keys:
-            shard_key = shard_key.decode()
-            shard_key = shard_key.replace(':connection-string', '')
-            shard_key = shard_key.replace('sharding:', '')
-            ctx.shard_key = shard_key
-
-            to_clean_ids = session.query(RestfulpyTask.id) \
-                .filter(RestfulpyTask.started_at < time_limitation) \
-                .filter(RestfulpyTask.status == RESTFULPY_TASK_SUCCESS)
-
-            for task_class in RestfulpyTask.__subclasses__():
-                session.query(task_class) \
-                    .filter(task_class.id.in_(to_clean_ids)) \
-                    .delete(synchronize_session=False)
+    def cleanup(cls, time_limitation, session=DBSession, batch_size=None,
+                archive_table=None):
+        batch_size = batch_size or settings.worker.cleanup_batch_size
+        archive_table = archive_table or settings.worker.cleanup_archive_table
+        deleted = for_each_shard(
+            lambda shard_key, shard_session: cls._cleanup_shard(
+                time_limitation,
+                shard_session,
+                batch_size,
+                archive_table,
+            ),
+            session,
+        )
+        return sum(deleted.values())
+
+    @staticmethod
+    def get_archive_table(archive_table, table):
+        """Returns the name of the table to archive the rows of the `table`
+        in: `archive_table` itself for the `restfulpy_task` and
+        `<archive_table>_<table>` for the tables of the subclasses.
+        """
+        if table is RestfulpyTask.__table__:
+            return archive_table
+
+        return f'{archive_table}_{table.name}'
+
+    @classmethod
+    def _cleanup_shard(cls, time_limitation, session, batch_size,
+                       archive_table):
+        base_table = RestfulpyTask.__table__
+        tables = list(RestfulpyTask.iter_tables())
+        started_at = time.monotonic()
+        deleted = 0
+        last_id = 0
+
+        while True:
+            task_ids = [row[0] for row in session.execute(
+                select(base_table.c.id)
+                .where(base_table.c.id > last_id)
+                .where(base_table.c.started_at < time_limitation)
+                .where(base_table.c.status == RESTFULPY_TASK_SUCCESS)
+                .order_by(base_table.c.id)
+                .limit(batch_size)
+                .with_for_update(skip_locked=True)
+            )]
+            if not task_ids:
                 session.commit()
+                break
+
+            if archive_table:
+                for table in tables:
+                    archive = cls.get_archive_table(archive_table, table)
+                    columns = ', '.join(c.name for c in table.columns)
+                    session.execute(
+                        text(
+                            f'INSERT INTO {archive} ({columns}) '
+                            f'SELECT {columns} FROM {table.name} '
+                            f'WHERE id = ANY(:ids)'
+                        ),
+                        dict(ids=task_ids)
+                    )
+
+            for table in tables:
+                session.execute(
+                    table.delete().where(table.c.id.in_(task_ids))
+                )
 
-            session.query(RestfulpyTask) \
-                .filter(RestfulpyTask.id.in_(to_clean_ids)) \
-                .delete(synchronize_session=False)
             session.commit()
+            last_id = task_ids[-1]
+            deleted += len(task_ids)
+            elapsed = time.monotonic() - started_at
+            logger.info(
+                f'{deleted} tasks are cleaned up, '
+                f'{deleted / elapsed:.1f} rows/sec.'
+            )
+
+        return deleted
+
+    @classmethod
+    @with_context
+    def maintain_partitions(cls, time_limitation, session=DBSession,
+                            ahead=None):
+        def maintain(shard_key, shard_session):
+            cls.create_partitions(shard_session, ahead)
+            cls.retire_partitions(time_limitation, shard_session)
+            shard_session.commit()
+
+        for_each_shard(maintain, session)
+
+    @classmethod
+    def create_partitions(cls, session=DBSession, ahead=None):
+        """Creates the current and the upcoming id range partitions.
+
+        Partitions are created for all of the tables in the polymorphic
+        hierarchy with the same bounds, named `<table>_p<lower-bound>`.
+        """
+        interval = settings.worker.partitioning.interval
+        ahead = settings.worker.partitioning.ahead if ahead is None else ahead
+        current = _last_task_id(session) // interval
+        for index in range(current, current + ahead + 1):
+            start = index * interval
+            for table in reversed(list(cls.iter_tables())):
+                session.execute(text(
+                    f'CREATE TABLE IF NOT EXISTS {table.name}_p{start} '
+                    f'PARTITION OF {table.name} '
+                    f'FOR VALUES FROM ({start}) TO ({start + interval})'
+                ))
+
+    @classmethod
+    def retire_partitions(cls, time_limitation, session=DBSession):
+        """Drops the filled partitions which have neither a pending task nor
+        a task created after the `time_limitation`.
+
+        :return: Lower bounds of the dropped partitions.
+        """
+        base_table = RestfulpyTask.__table__
+        partitions = session.execute(
+            text(
+                'SELECT c.relname FROM pg_inherits i '
+                'JOIN pg_class c ON c.oid = i.inhrelid '
+                'JOIN pg_class p ON p.oid = i.inhparent '
+                'WHERE p.relname = :table'
+            ),
+            dict(table=base_table.name)
+        ).scalars()
+        bounds = sorted(
+            int(m.group(1)) for m in (
+                re.match(rf'{base_table.name}_p(\d+)$', p) for p in partitions
+            ) if m
+        )
+
+        interval = settings.worker.partitioning.interval
+        last_id = _last_task_id(session)
+        retired = []
+        for start in bounds:
+            if start + interval > last_id:
+                # The active and the upcoming partitions
+                break
+
+            partition = f'{base_table.name}_p{start}'
+            # Stops at the first matching row, instead of counting them all
+            remaining = session.execute(
+                text(
+                    f'SELECT EXISTS (SELECT 1 FROM {partition} '
+                    f'WHERE created_at >= :time_limitation '
+                    f'OR status IN (\'new\', \'in-progress\') LIMIT 1)'
+                ),
+                dict(time_limitation=time_limitation)
+            ).scalar()
+            if remaining:
+                continue
+
+            for table in cls.iter_tables():
+                session.execute(text(
+                    f'ALTER TABLE {table.name} '
+                    f'DETACH PARTITION {table.name}_p{start}'
+                ))
+                session.execute(text(f'DROP TABLE {table.name}_p{start}'))
+
+            logger.info(f'Partition {partition} is retired.')
+            retired.append(start)
+
+        return retired
+
+    @staticmethod
+    def before_create_metadata(target, connection, **kw):
+        partition_by = 'RANGE (id)' \
+            if settings.worker.partitioning.enabled else None
+
+        # A unique index of a partitioned table should include the
+        # partition key.
+        dedup_index.unique = partition_by is None
+
+        for table in RestfulpyTask.iter_tables():
+            table.dialect_options['postgresql']['partition_by'] = partition_by
+
+    @staticmethod
+    def after_create_metadata(target, connection, **kw):
+        if settings.worker.partitioning.enabled:
+            RestfulpyTask.create_partitions(connection)
+
+    @classmethod
+    def renew_stale(cls, time_limitation, session=DBSession,
+                    batch_size=None):
+        """Resets the in-progress tasks with an expired lease, And the ones
+        without a lease which are started before the `time_limitation`.
+
+        See :func:`.lease.renew_expired_leases`.
+
+        :return: Number of the renewed tasks.
+        """
+        return len(renew_expired_leases(
+            RestfulpyTask,
+            'task',
+            RESTFULPY_TASK_IN_PROGRESS,
+            RESTFULPY_TASK_NEW,
+            time_limitation,
+            session,
+            batch_size or settings.renew_worker.batch_size,
+            settings.worker.notification_channel,
+        ))
 
     @classmethod
     def reset_status(
@@ -186,118 +927,525 @@ class RestfulpyTask(TimestampMixin, DeclarativeBase):
             .update({
                 'status': RESTFULPY_TASK_NEW,
                 'started_at': None,
-                'terminated_at': None
+                'terminated_at': None,
+                'worker_id': None,
+                'lease_expires_at': None,
             }, synchronize_session='fetch')
 
 
+def _group_by_keys(rows):
+    """Groups the rows with the same keys, so each group can be inserted
+    by a single statement and the omitted values are left to the column
+    defaults.
+    """
+    for _, group in groupby(sorted(rows, key=sorted), key=sorted):
+        yield list(group)
+
+
+def _insert_deduplicated(table, rows, on_conflict, session):
+    """Inserts the rows into the `restfulpy_task` table, ignoring or
+    replacing the pending tasks with the same `dedup_key`.
+
+    :return: A dictionary of the allocated ids of the inserted or replaced
+             rows to their final id.
+    """
+    task_ids = {}
+    for group in _group_by_keys(rows):
+        statement = insert(table).values(group)
+        if 'dedup_key' in group[0]:
+            index = dict(
+                index_elements=[table.c.type, table.c.dedup_key],
+                index_where=table.c.status.in_(PENDING_STATUSES),
+            )
+            if on_conflict == 'replace':
+                set_ = {
+                    k: statement.excluded[k] for k in group[0]
+                    if k not in ('id', 'type')
+                }
+                # The replaced task starts over, so the backoff and the
+                # failure of its earlier tries don't carry on.
+                set_.setdefault('run_after', statement.excluded.run_after)
+                set_.setdefault('retries', 0)
+                set_.setdefault('fail_reason', None)
+                statement = statement.on_conflict_do_update(
+                    set_=set_,
+                    where=table.c.status == RESTFULPY_TASK_NEW,
+                    **index
+                )
+            else:
+                statement = statement.on_conflict_do_nothing(**index)
+
+        allocated = {r['id'] for r in group}
+        by_key = {r.get('dedup_key'): r['id'] for r in group}
+        result = session.execute(
+            statement.returning(table.c.id, table.c.dedup_key)
+        )
+        for task_id, dedup_key in result:
+            if task_id in allocated:
+                task_ids[task_id] = task_id
+            else:
+                task_ids[by_key[dedup_key]] = task_id
+
+    return task_ids
+
+
+def _last_task_id(session):
+    return session.execute(text(
+        'SELECT coalesce(pg_sequence_last_value(pg_get_serial_sequence('
+        f'\'{RestfulpyTask.__tablename__}\', \'id\')::regclass), 0)'
+    )).scalar()
+
+
+listen(metadata, 'before_create', RestfulpyTask.before_create_metadata)
+listen(metadata, 'after_create', RestfulpyTask.after_create_metadata)
+
+# The partial indexes to keep the pop and renew queries away from the
+# (usually huge) set of the finished tasks.
+Index(
+    'ix_restfulpy_task_pending',
+    RestfulpyTask.__table__.c.priority.desc(),
+    RestfulpyTask.__table__.c.created_at,
+    postgresql_where=RestfulpyTask.__table__.c.status == RESTFULPY_TASK_NEW,
+)
+Index(
+    'ix_restfulpy_task_pending_type',
+    RestfulpyTask.__table__.c.type,
+    RestfulpyTask.__table__.c.priority.desc(),
+    RestfulpyTask.__table__.c.created_at,
+    postgresql_where=RestfulpyTask.__table__.c.status == RESTFULPY_TASK_NEW,
+)
+Index(
+    'ix_restfulpy_task_in_progress',
+    RestfulpyTask.__table__.c.started_at,
+    postgresql_where=(
+        RestfulpyTask.__table__.c.status == RESTFULPY_TASK_IN_PROGRESS
+    ),
+)
+dedup_index = Index(
+    'ix_restfulpy_task_dedup_key',
+    RestfulpyTask.__table__.c.type,
+    RestfulpyTask.__table__.c.dedup_key,
+    unique=True,
+    postgresql_where=(
+        RestfulpyTask.__table__.c.status.in_(PENDING_STATUSES)
+    ),
+)
+Index(
+    'ix_restfulpy_task_lease',
+    RestfulpyTask.__table__.c.lease_expires_at,
+    postgresql_where=(
+        RestfulpyTask.__table__.c.status == RESTFULPY_TASK_IN_PROGRESS
+    ),
+)
+
+
+def _wait_for_tasks(listener, statuses, filters, session, stop=None):
+    timeout = settings.worker.notification_timeout
+    run_after = RestfulpyTask.next_run_after(statuses, filters, session)
+    session.rollback()
+    if run_after is not None:
+        if run_after.tzinfo is not None:
+            run_after = run_after.astimezone(timezone.utc).replace(tzinfo=None)
+
+        timeout = min(
+            timeout,
+            (run_after - datetime.utcnow()).total_seconds()
+        )
+
+    listener.wait(timeout, stop)
+
+
+def _release(task_ids, session, heartbeat=None):
+    """Gives back the popped but not executed tasks to the queue."""
+    if not task_ids:
+        return
+
+    table = RestfulpyTask.__table__
+    session.execute(
+        table.update()
+        .where(table.c.id.in_(task_ids))
+        .where(table.c.status == RESTFULPY_TASK_IN_PROGRESS)
+        .values(
+            status=RESTFULPY_TASK_NEW,
+            started_at=None,
+            retries=table.c.retries - 1,
+            worker_id=None,
+            lease_expires_at=None,
+        )
+    )
+    session.commit()
+    if heartbeat is not None:
+        for task_id in task_ids:
+            heartbeat.discard(task_id)
+
+
 @with_context
-def worker(statuses={RESTFULPY_TASK_NEW}, filters=None, tries=-1):
-    isolated_session = create_thread_unsafe_session()
+def worker(statuses={RESTFULPY_TASK_NEW}, filters=None, tries=-1,
+           batch_size=None, stop=None):
+    isolated_session = create_thread_unsafe_session(expire_on_commit=False)
+    table = RestfulpyTask.__table__
+    metrics = get_metrics_sink()
     context = {'counter': 0}
     tasks = []
+    batch_size = batch_size or settings.worker.batch_size
+    listener = None
+    if settings.worker.notification_channel:
+        listener = PostgreSQLListener(
+            settings.worker.notification_channel
+        ).listen()
 
-    while True:
-        context['counter'] += 1
+    worker_id, heartbeat = start_heartbeat(RestfulpyTask)
 
-        try:
-            task = RestfulpyTask.pop(
-                statuses=statuses,
-                filters=filters,
-                session=isolated_session
-            )
-            assert task is not None
+    try:
+        while stop is None or not stop.is_set():
+            try:
+                claim_started_at = time.monotonic()
+                batch = RestfulpyTask.pop_many(
+                    batch_size,
+                    statuses=statuses,
+                    filters=filters,
+                    session=isolated_session,
+                    worker_id=worker_id,
+                )
+                metrics.observe(
+                    'task_claim_seconds',
+                    time.monotonic() - claim_started_at
+                )
 
-        except TaskPopError as ex:
-            isolated_session.rollback()
-            if tries > -1:
-                tries -= 1
-                if tries <= 0:
-                    return tasks
+            except Exception as exp:
+                logger.error(f'Error when popping task. {exp.__doc__}')
+                raise exp
 
-            time.sleep(settings.worker.gap)
-            continue
+            if not batch:
+                isolated_session.rollback()
+                if tries > -1:
+                    tries -= 1
+                    if tries <= 0:
+                        return tasks
 
-        except Exception as exp:
-            logger.error(f'Error when popping task. {exp.__doc__}')
-            raise exp
+                if listener is not None:
+                    _wait_for_tasks(
+                        listener,
+                        statuses,
+                        filters,
+                        isolated_session,
+                        stop,
+                    )
+                elif stop is not None:
+                    stop.wait(settings.worker.gap)
+                else:
+                    time.sleep(settings.worker.gap)
+
+                continue
+
+            if heartbeat is not None:
+                for task in batch:
+                    heartbeat.add(task.id)
+
+            task_ids = [task.id for task in batch]
+            for index, task in enumerate(batch):
+                context['counter'] += 1
+                # The rollback of a failed task expires it, so these are
+                # taken beforehand.
+                task_id = task_ids[index]
+                task_type = task.type
+                fail_reason = task.fail_reason
+                delay = task.get_retry_delay()
+                wait = (task.started_at - task.created_at).total_seconds()
+                values = None
+                timed_out = False
+                started_at = time.monotonic()
 
+                try:
+                    task.execute(context, isolated_session)
+                    values = dict(status=RESTFULPY_TASK_SUCCESS)
+
+                except MaxRetriesExceededError as exp:
+                    values = dict(status=RESTFULPY_TASK_FAILED)
+
+                except TaskTimeoutError as exp:
+                    values = dict(
+                        status=RESTFULPY_TASK_FAILED,
+                        fail_reason=str(exp),
+                        terminated_at=datetime.utcnow(),
+                    )
+                    logger.critical(dict(
+                        message=str(exp),
+                        taskId=task_id,
+                    ))
+
+                    # The session is still in use by the task's thread
+                    timed_out = True
+                    isolated_session = create_thread_unsafe_session(
+                        expire_on_commit=False
+                    )
+
+                except Exception as exp:
+                    values = dict(status=RESTFULPY_TASK_NEW)
+                    if delay is not None:
+                        values['run_after'] = datetime.utcnow() + \
+                            timedelta(seconds=delay)
+
+                    if fail_reason != traceback.format_exc()[-4096:]:
+                        values['fail_reason'] = traceback.format_exc()[-4096:]
+                        logger.critical(dict(
+                            message=f'Error when executing task: {task_id}',
+                            taskId=task_id,
+                            exception=exp.__doc__,
+                            failReason=values['fail_reason'],
+                        ))
+
+                finally:
+                    try:
+                        if values is not None:
+                            if values['status'] != RESTFULPY_TASK_SUCCESS:
+                                isolated_session.execute(
+                                    table.update()
+                                    .where(table.c.id == task_id)
+                                    .values(**values)
+                                )
+                                isolated_session.commit()
+
+                            tasks.append((task_id, values['status']))
+                            report_task(
+                                metrics,
+                                'task',
+                                task_type,
+                                values['status'],
+                                wait,
+                                time.monotonic() - started_at,
+                            )
+                    except Exception as exp:
+                        logger.critical(exp, exc_info=True)
+
+                    if heartbeat is not None:
+                        heartbeat.discard(task_id)
+
+                if timed_out:
+                    # The rest of the batch belongs to the abandoned session
+                    _release(task_ids[index + 1:], isolated_session, heartbeat)
+                    break
+
+        return tasks
+
+    finally:
+        if listener is not None:
+            listener.close()
+
+        stop_heartbeat(heartbeat)
+
+        isolated_session.close()
+        metrics.flush()
+
+
+async def async_worker(statuses={RESTFULPY_TASK_NEW}, filters=None,
+                       tries=-1, batch_size=None, concurrency=None,
+                       stop=None):
+    """Runs the :meth:`RestfulpyTask.do_async` of up to `concurrency` tasks
+    at the same time.
+
+    Only the types which implement `do_async` are popped. The database is
+    accessed by a dedicated thread, so the event loop is never blocked by
+    popping or finishing the tasks.
+    """
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(1, thread_name_prefix='async-worker-db')
+    concurrency = concurrency or settings.worker.concurrency
+    batch_size = batch_size or settings.worker.batch_size
+    table = RestfulpyTask.__table__
+    metrics = get_metrics_sink()
+    context = {'counter': 0}
+    tasks = []
+    running = set()
+    types_filter = table.c.type.in_(RestfulpyTask.get_async_types())
+    if filters is None:
+        filters = types_filter
+    else:
+        filters = and_(
+            types_filter,
+            text(filters) if isinstance(filters, str) else filters
+        )
+
+    def database(func, *args, **kwargs):
+        return loop.run_in_executor(
+            executor,
+            functools.partial(func, *args, **kwargs)
+        )
+
+    isolated_session = await database(
+        create_thread_unsafe_session,
+        expire_on_commit=False
+    )
+    worker_id, heartbeat = start_heartbeat(RestfulpyTask)
+
+    def pop(size):
+        claim_started_at = time.monotonic()
+        batch = RestfulpyTask.pop_many(
+            size,
+            statuses=statuses,
+            filters=filters,
+            session=isolated_session,
+            worker_id=worker_id,
+        )
+        isolated_session.expunge_all()
+        metrics.observe(
+            'task_claim_seconds',
+            time.monotonic() - claim_started_at
+        )
+        return batch
+
+    def finish(task_id, values):
+        isolated_session.execute(
+            table.update().where(table.c.id == task_id).values(**values)
+        )
+        isolated_session.commit()
+
+    async def run(task):
+        context['counter'] += 1
+        started_at = time.monotonic()
         try:
-            task.execute(context)
+            if task.__max_retries__ is not None and \
+                    task.retries >= task.__max_retries__:
+                raise MaxRetriesExceededError()
 
-            # Task success
-            task.status = RESTFULPY_TASK_SUCCESS
-            task.terminated_at = datetime.utcnow()
+            await task._do_async_with_timeout(context)
+            values = dict(
+                status=RESTFULPY_TASK_SUCCESS,
+                terminated_at=datetime.utcnow(),
+            )
 
-        except MaxRetriesExceededError as exp:
-            task.status = RESTFULPY_TASK_FAILED
-            # task.fail_reason = traceback.format_exc()[-4096:]
+        except MaxRetriesExceededError:
+            values = dict(status=RESTFULPY_TASK_FAILED)
+
+        except TaskTimeoutError as exp:
+            values = dict(
+                status=RESTFULPY_TASK_FAILED,
+                fail_reason=str(exp),
+                terminated_at=datetime.utcnow(),
+            )
+            logger.critical(dict(
+                message=values['fail_reason'],
+                taskId=task.id,
+            ))
 
         except Exception as exp:
-            task.status = 'new'
+            values = dict(status=RESTFULPY_TASK_NEW)
+            delay = task.get_retry_delay()
+            if delay is not None:
+                values['run_after'] = datetime.utcnow() + \
+                    timedelta(seconds=delay)
+
             if task.fail_reason != traceback.format_exc()[-4096:]:
-                task.fail_reason = traceback.format_exc()[-4096:]
+                values['fail_reason'] = traceback.format_exc()[-4096:]
                 logger.critical(dict(
                     message=f'Error when executing task: {task.id}',
                     taskId=task.id,
                     exception=exp.__doc__,
-                    failReason=task.fail_reason,
+                    failReason=values['fail_reason'],
                 ))
 
-        finally:
+        try:
+            await database(finish, task.id, values)
+            tasks.append((task.id, values['status']))
+            report_task(
+                metrics,
+                'task',
+                task.type,
+                values['status'],
+                (task.started_at - task.created_at).total_seconds(),
+                time.monotonic() - started_at,
+            )
+        except Exception as exp:
+            logger.critical(exp, exc_info=True)
+            await database(isolated_session.rollback)
+
+        if heartbeat is not None:
+            heartbeat.discard(task.id)
+
+    try:
+        while stop is None or not stop.is_set():
+            running = {t for t in running if not t.done()}
+            size = min(batch_size, concurrency - len(running))
+            if size <= 0:
+                await asyncio.wait(
+                    running,
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+                continue
+
             try:
-                if isolated_session.is_active:
-                    isolated_session.commit()
+                batch = await database(pop, size)
 
-                tasks.append((task.id, task.status))
             except Exception as exp:
-                logger.critical(exp, exc_info=True)
+                logger.error(f'Error when popping task. {exp.__doc__}')
+                raise exp
 
+            if not batch:
+                await database(isolated_session.rollback)
+                if running:
+                    # Waiting for a running task to finish, or the gap.
+                    await asyncio.wait(
+                        running,
+                        timeout=settings.worker.gap,
+                        return_when=asyncio.FIRST_COMPLETED
+                    )
+                    continue
 
-@with_context
-def renew(session=DBSession):
-    shard_keys = [b'sharding:test:connection-string']
+                if tries > -1:
+                    tries -= 1
+                    if tries <= 0:
+                        return tasks
 
-    while True:
-        renew_time_range = datetime.utcnow() - \
-            timedelta(minutes=settings.renew_worker.time_range)
+                await asyncio.sleep(settings.worker.gap)
+                continue
 
-        if settings.is_database_sharding:
-            shard_keys = get_shard_keys()
+            for task in batch:
+                if heartbeat is not None:
+                    heartbeat.add(task.id)
 
-        for shard_key in shard_keys:
-            shard_key = shard_key.decode()
-            shard_key = shard_key.replace(':connection-string', '')
-            shard_key = shard_key.replace('sharding:', '')
-            ctx.shard_key = shard_key
+                running.add(loop.create_task(run(task)))
 
-            task_id = None
-            try:
-                task = session.query(RestfulpyTask) \
-                    .with_for_update() \
-                    .filter(
-                        RestfulpyTask.status == RESTFULPY_TASK_IN_PROGRESS,
-                        RestfulpyTask.started_at <= renew_time_range
-                    ) \
-                    .order_by(RestfulpyTask.id) \
-                    .first()
-                if task is None:
-                    continue
+        if running:
+            await asyncio.wait(running)
 
-                task_id = task.id
-                task.status = RESTFULPY_TASK_NEW
-                task.started_at = None
-                task.terminated_at = None
-                session.commit()
-                logger.info(f'Task: {task_id} successfully renewed.')
+        return tasks
 
-            except OperationalError as exp:
-                logger.critical(exp, exc_info=True)
-                break
+    finally:
+        stop_heartbeat(heartbeat)
 
-            except Exception as exp:
-                if task_id is not None:
-                    logger.error(f'Error when renewing task: {task_id}')
-                logger.error(exp, exc_info=True)
-                session.rollback()
-        time.sleep(settings.renew_worker.gap)
+        await database(isolated_session.close)
+        executor.shutdown()
+        metrics.flush()
 
+
+@with_context
+def run_async_worker(**kwargs):
+    """Runs the :func:`async_worker` in a new event loop, to be used as a
+    :class:`.supervisor.Supervisor` target.
+    """
+    return asyncio.run(async_worker(**kwargs))
+
+
+@with_context
+def renew(session=DBSession):
+    def renew_shard(shard_key, session):
+        try:
+            renewed = RestfulpyTask.renew_stale(renew_time_range, session)
+            if renewed:
+                logger.info(f'{renewed} task(s) successfully renewed.')
+
+        except OperationalError as exp:
+            logger.critical(exp, exc_info=True)
+            session.rollback()
+
+        except Exception as exp:
+            logger.error(f'Error when renewing tasks of: {shard_key}')
+            logger.error(exp, exc_info=True)
+            session.rollback()
+
+    while True:
+        renew_time_range = datetime.utcnow() - \
+            timedelta(minutes=settings.renew_worker.time_range)
+
+        for_each_shard(renew_shard, session)
+        time.sleep(settings.renew_worker.gap)
@@ -1,7 +1,7 @@
 import time
 
-from bddcli import Given, stderr, Application, status, when, story, \
-    given
+from bddcli import Given, stderr, stdout, Application, status, when, \
+    story, given
 
 from restfulpy import Application as RestfulpyApplication
 from restfulpy.mule import MuleTask
@@ -37,6 +37,21 @@ def foo_main():
 app = Application('foo', 'tests.test_appcli_mule:foo_main')
 
 
+def test_appcli_mule_stats(db):
+    session = db()
+    session.add(WorkerTask())
+    session.commit()
+
+    with Given(app, 'mule stats'):
+        assert stderr == ''
+        assert status == 0
+        assert 'worker_task' in stdout
+
+        when(given + '--all')
+        assert stderr == ''
+        assert status == 0
+
+
 def test_appcli_mule_start(db):
     session = db()
     task = WorkerTask()
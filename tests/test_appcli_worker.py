@@ -1,7 +1,7 @@
 import time
 
-from bddcli import Given, stderr, Application, status, when, story, \
-    given
+from bddcli import Given, stderr, stdout, Application, status, when, \
+    story, given
 
 from restfulpy import Application as RestfulpyApplication
 from restfulpy.taskqueue import RestfulpyTask
@@ -43,6 +43,21 @@ def test_appcli_worker_cleanup(db):
         assert status == 0
 
 
+def test_appcli_worker_stats(db):
+    session = db()
+    session.add(WorkerTask())
+    session.commit()
+
+    with Given(app, 'worker stats'):
+        assert stderr == ''
+        assert status == 0
+        assert 'worker_task' in stdout
+
+        when(given + '--all')
+        assert stderr == ''
+        assert status == 0
+
+
 def test_appcli_worker_start(db):
     session = db()
     task = WorkerTask()
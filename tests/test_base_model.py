@@ -1,5 +1,7 @@
+from datetime import date, datetime
+
 from bddrest import response, when, Update, status
-from nanohttp import json, settings
+from nanohttp import json, settings, action
 from sqlalchemy import Unicode, Integer, Date, Float, ForeignKey, Boolean, \
     DateTime
 from sqlalchemy.ext.associationproxy import association_proxy
@@ -191,6 +193,19 @@ class Root(JSONPatchControllerMixin, ModelRestController):
             return query.filter(Member.title == title).one_or_none()
         return query
 
+    @action(content_type='application/json')
+    @Member.expose(stream=True)
+    def export(self, title: str = None):
+        query = DBSession.query(Member)
+        if title:
+            return query.filter(Member.title == title).one_or_none()
+        return query
+
+    @json
+    @Member.expose(projection=True)
+    def fast(self):
+        return DBSession.query(Member)
+
     @json
     @Member.expose
     def me(self):
@@ -275,6 +290,71 @@ class TestBaseModel(ApplicableTestCase):
             when('Getting a plain dictionary', '/me')
             assert response.json == {'title': 'me'}
 
+    def test_streaming(self):
+        with self.given('Getting the members', '/'):
+            members = response.json
+
+        with self.given('Streaming the members', '/export'):
+            assert status == 200
+            assert response.content_type == 'application/json'
+            assert response.json == members
+
+            when('Paginating', query=dict(take=1))
+            assert response.json == members[:1]
+
+            when('Trying to get an non-existence object', query=dict(
+                title='non-existence'
+            ))
+            assert status == 404
+
+        Member.__stream_chunk_size__ = 1
+        try:
+            with self.given('Streaming by small chunks', '/export'):
+                assert response.json == members
+
+        finally:
+            del Member.__stream_chunk_size__
+
+    def test_projection(self):
+        session = self.create_session()
+        session.add(Member(
+            email='avatar@example.com',
+            title='avatar',
+            password='123456',
+            first_name='avatar',
+            last_name='avatar',
+            birth=date(2001, 1, 1),
+            last_login_time=datetime(2017, 10, 10, 15, 44, 30),
+            avatar='image.png',
+        ))
+        session.commit()
+
+        with self.given('Getting the members', '/', query=dict(sort='id')):
+            members = response.json
+
+        names = {name for _, name, _ in Member.get_projection_plan()}
+        assert 'isActive' in names
+        assert 'avatarImage' in names
+        assert 'books' not in names
+        assert 'fullName' not in names
+
+        with self.given(
+            'Getting only the columns',
+            '/fast',
+            query=dict(sort='id')
+        ):
+            assert status == 200
+            assert response.json == [
+                {k: v for k, v in m.items() if k in names} for m in members
+            ]
+
+            # The synonym is selected by its target column
+            assert 'avatar:image.png' in \
+                [m['avatarImage'] for m in response.json]
+
+            when('Paginating', query=Update(take=1))
+            assert len(response.json) == 1
+
     def test_iter_columns(self):
         columns = {
             c.key: c for c in Member.iter_columns(
@@ -343,3 +423,34 @@ class TestBaseModel(ApplicableTestCase):
                 'The phone number cannot contain alphabet'
             assert fields['password']['label'] == 'Password'
 
+            etag = response.headers['ETag']
+            assert etag.startswith('"')
+
+            when(
+                'The metadata is not modified',
+                headers={'If-None-Match': etag}
+            )
+            assert status == 304
+            assert response.headers['ETag'] == etag
+            assert response.body == b''
+
+            when(
+                'The metadata is modified',
+                headers={'If-None-Match': '"foo", W/"bar"'}
+            )
+            assert status == 200
+            assert response.json['name'] == 'Member'
+
+    def test_metadata_cache(self):
+        metadata = Member.json_metadata()
+        metadata['fields'].clear()
+        assert Member.json_metadata()['fields']
+        assert Member.get_metadata_response() is \
+            Member.get_metadata_response()
+
+        rules = Member.create_validation_rules(ignore=['title'])
+        assert 'title' not in rules
+        assert 'required' not in rules['email']
+        rules['email']['foo'] = 'bar'
+        assert 'foo' not in Member.create_validation_rules()['email']
+        assert 'required' in Member.create_validation_rules(strict=True)['id']
@@ -0,0 +1,46 @@
+from datetime import datetime
+
+import pytest
+
+from restfulpy.cron import CronExpression
+
+
+def test_cron_expression():
+    moment = datetime(2024, 2, 28, 23, 59, 30)
+
+    assert CronExpression('* * * * *').next(moment) == \
+        datetime(2024, 2, 29, 0, 0)
+    assert CronExpression('*/15 * * * *').next(datetime(2024, 1, 1, 0, 1)) \
+        == datetime(2024, 1, 1, 0, 15)
+    assert CronExpression('0 3 * * *').next(moment) == \
+        datetime(2024, 2, 29, 3, 0)
+    assert CronExpression('0 0 29 2 *').next(datetime(2024, 3, 1)) == \
+        datetime(2028, 2, 29)
+
+    # Weekdays, 2024-02-29 is Thursday
+    assert CronExpression('30 9 * * 1-5').next(moment) == \
+        datetime(2024, 2, 29, 9, 30)
+    assert CronExpression('0 12 * * 7').next(moment) == \
+        datetime(2024, 3, 3, 12, 0)
+    assert CronExpression('0 12 * * 0,6').next(moment) == \
+        datetime(2024, 3, 2, 12, 0)
+
+    # Either the day of month or the day of week
+    assert CronExpression('0 0 1 * 0').next(moment) == \
+        datetime(2024, 3, 1)
+    assert CronExpression('0 0 15 * 0').next(moment) == \
+        datetime(2024, 3, 3)
+
+    # Lists and steps of ranges
+    expression = CronExpression('0,30 8-18/5 * 1,7 *')
+    assert expression.hours == {8, 13, 18}
+    assert expression.next(moment) == datetime(2024, 7, 1, 8, 0)
+
+    with pytest.raises(ValueError):
+        CronExpression('* * * *')
+
+    with pytest.raises(ValueError):
+        CronExpression('60 * * * *')
+
+    with pytest.raises(ValueError):
+        CronExpression('0 0 31 2 *').next(moment)
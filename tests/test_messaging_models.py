@@ -32,3 +32,29 @@ def test_messaging_model(db):
         'to': 'test@example.com'
     }
 
+
+def test_enqueue_many(db):
+    settings.merge('''
+    messaging:
+      default_sender: test@example.com
+    ''')
+    session = db()
+
+    ids = Email.enqueue_many(
+        (
+            dict(to=f'user{i}@example.com', subject='News', body={'i': i})
+            for i in range(5)
+        ),
+        session=session,
+        batch_size=2,
+    )
+    session.commit()
+    assert len(ids) == 5
+
+    emails = session.query(Email).order_by(Email.id).all()
+    assert [e.id for e in emails] == ids
+    assert emails[4].to == 'user4@example.com'
+    assert emails[4].body == {'i': 4}
+    assert emails[4].from_ == 'test@example.com'
+    assert emails[4].status == 'new'
+    assert emails[4].type == 'email'
@@ -0,0 +1,147 @@
+import socket
+from datetime import datetime, timedelta
+from os import path
+
+from nanohttp import settings
+
+from restfulpy.metrics import MetricsSink, PrometheusFileSink, StatsDSink, \
+    get_metrics_sink
+from restfulpy.mule import MuleTask
+from restfulpy.taskqueue import RestfulpyTask, worker
+
+
+class MemorySink(MetricsSink):
+    def __init__(self):
+        self.counters = {}
+        self.observations = {}
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.observations.setdefault(key, []).append(value)
+
+
+class MeasuredTask(RestfulpyTask):
+
+    __mapper_args__ = {
+        'polymorphic_identity': 'measured_task'
+    }
+
+    def do_(self, context):
+        # Fails at the first try
+        if self.priority == 0 and self.retries == 1:
+            raise Exception()
+
+
+def test_worker_metrics(db):
+    session = db()
+    settings.metrics.sink = 'tests.test_metrics.MemorySink'
+    session.add(MeasuredTask())
+    session.add(MeasuredTask())
+    session.add(MeasuredTask(priority=0))
+    session.commit()
+
+    stats = RestfulpyTask.get_stats(session=session)
+    assert [row[:4] for row in stats] == [
+        ('new', 'measured_task', 50, 2),
+        ('new', 'measured_task', 0, 1),
+    ]
+    assert stats[0][4] >= 0
+
+    tasks = worker(tries=0, filters=RestfulpyTask.type == 'measured_task')
+    assert len(tasks) == 4
+
+    sink = get_metrics_sink()
+    assert isinstance(sink, MemorySink)
+    type_ = (('type', 'measured_task'), )
+    assert sink.counters == {
+        ('task_finished_total', type_ + (('status', 'success'), )): 3,
+        ('task_finished_total', type_ + (('status', 'new'), )): 1,
+    }
+    assert len(sink.observations[('task_duration_seconds', type_)]) == 4
+    assert len(sink.observations[('task_wait_seconds', type_)]) == 4
+    assert len(sink.observations[('task_claim_seconds', ())]) == 5
+
+    stats = RestfulpyTask.get_stats(statuses=None, session=session)
+    assert [row[:4] for row in stats] == [
+        ('success', 'measured_task', 50, 2),
+        ('success', 'measured_task', 0, 1),
+    ]
+
+
+def test_renew_metrics(db):
+    session = db()
+    settings.metrics.sink = 'tests.test_metrics.MemorySink'
+    sink = get_metrics_sink()
+    sink.counters.clear()
+    ten_minutes_ago = datetime.utcnow() - timedelta(minutes=10)
+    for i in range(3):
+        session.add(
+            MeasuredTask(status='in-progress', started_at=ten_minutes_ago)
+        )
+        session.add(MuleTask(status='in-progress', started_at=ten_minutes_ago))
+    session.commit()
+
+    five_minutes_ago = datetime.utcnow() - timedelta(minutes=5)
+    assert RestfulpyTask.renew_stale(
+        five_minutes_ago,
+        session,
+        batch_size=2
+    ) == 3
+    assert MuleTask.renew_stale(five_minutes_ago, session) == 3
+
+    assert sink.counters == {
+        ('task_renewed_total', (('type', 'measured_task'), )): 3,
+        ('job_renewed_total', (('type', 'mule_task'), )): 3,
+    }
+
+
+def test_prometheus_file_sink(db, tmpdir):
+    db()
+    settings.metrics.prometheus.filename = \
+        path.join(tmpdir, 'restfulpy-{pid}.prom')
+    settings.metrics.buckets = [1, .1]
+
+    sink = PrometheusFileSink()
+    sink.increment('task_finished_total', type='email', status='success')
+    sink.increment('task_finished_total', type='email', status='success')
+    sink.observe('task_duration_seconds', .05, type='email')
+    sink.observe('task_duration_seconds', .5, type='email')
+    sink.flush()
+
+    with open(sink.filename) as f:
+        assert f.read().splitlines() == [
+            'task_finished_total{status="success",type="email"} 2',
+            'task_duration_seconds_bucket{type="email",le="0.1"} 1',
+            'task_duration_seconds_bucket{type="email",le="1"} 2',
+            'task_duration_seconds_bucket{type="email",le="+Inf"} 2',
+            'task_duration_seconds_sum{type="email"} 0.55',
+            'task_duration_seconds_count{type="email"} 2',
+        ]
+
+
+def test_statsd_sink(db):
+    db()
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(('127.0.0.1', 0))
+    server.settimeout(1)
+    settings.metrics.statsd.merge(dict(
+        host='127.0.0.1',
+        port=server.getsockname()[1],
+        prefix='foo',
+    ))
+
+    try:
+        sink = StatsDSink()
+        sink.increment('task_finished_total', type='email', status='failed')
+        assert server.recv(1024) == \
+            b'foo.task_finished_total.failed.email:1|c'
+
+        sink.observe('task_duration_seconds', .25, type='email')
+        assert server.recv(1024) == \
+            b'foo.task_duration_seconds.email:250.000|ms'
+    finally:
+        server.close()
@@ -3,7 +3,8 @@ from nanohttp import HTTPBadRequest, settings
 from nanohttp.contexts import Context
 from sqlalchemy import Integer, Unicode
 
-from restfulpy.orm import DeclarativeBase, Field, PaginationMixin
+from restfulpy.orm import DeclarativeBase, Field, PaginationMixin, \
+    OrderingMixin
 
 
 class PagingObject(PaginationMixin, DeclarativeBase):
@@ -14,6 +15,33 @@ class PagingObject(PaginationMixin, DeclarativeBase):
     title = Field(Unicode(50))
 
 
+class SortedPagingObject(PaginationMixin, OrderingMixin, DeclarativeBase):
+    __tablename__ = 'sorted_paging_object'
+
+    id = Field(Integer, primary_key=True)
+    title = Field(Unicode(50), nullable=True)
+
+
+def paginate_by_cursor(model, query, take, sort=None):
+    cursor = ''
+    ids = []
+    while cursor is not None:
+        query_string = f'take={take}&cursor={cursor}'
+        if sort:
+            query_string += f'&sort={sort}'
+
+        with Context({'QUERY_STRING': query_string}) as context:
+            page = model.paginate_by_request(model.sort_by_request(query)) \
+                if sort else model.paginate_by_request(query)
+            ids.extend(o.id for o in page)
+            assert context.response_headers['X-Pagination-Take'] == \
+                str(take)
+            assert 'X-Pagination-Count' not in context.response_headers
+            cursor = context.response_headers.get('X-Pagination-Cursor')
+
+    return ids
+
+
 def test_pagination_mixin(db):
     assert settings.is_testing is True
 
@@ -41,3 +69,40 @@ def test_pagination_mixin(db):
     with Context({'QUERY_STRING': 'take=5'}), pytest.raises(HTTPBadRequest):
         PagingObject.paginate_by_request(query)
 
+
+def test_cursor_pagination(db):
+    session = db()
+
+    for i in range(1, 6):
+        session.add(PagingObject(title=f'object {i}'))
+        session.add(SortedPagingObject(title=None if i % 2 else f'{i % 3}'))
+    session.commit()
+
+    query = session.query(PagingObject)
+    for take in (1, 2, 4):
+        assert paginate_by_cursor(PagingObject, query, take) == \
+            [1, 2, 3, 4, 5]
+
+    with Context({'QUERY_STRING': 'cursor=invalid'}), \
+            pytest.raises(HTTPBadRequest):
+        PagingObject.paginate_by_request(query)
+
+    with Context({'QUERY_STRING': 'cursor=&take=5'}), \
+            pytest.raises(HTTPBadRequest):
+        PagingObject.paginate_by_request(query)
+
+    # Seeking by the sort columns, the nulls come last in ascending order
+    query = session.query(SortedPagingObject)
+    for take in (1, 2, 3):
+        assert paginate_by_cursor(
+            SortedPagingObject,
+            query,
+            take,
+            sort='title'
+        ) == [4, 2, 5, 3, 1]
+        assert paginate_by_cursor(
+            SortedPagingObject,
+            query,
+            take,
+            sort='-title,id'
+        ) == [1, 3, 5, 2, 4]
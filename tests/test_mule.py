@@ -1,12 +1,19 @@
 import threading
+import time
 import datetime
+from collections import Counter
 
-from restfulpy.mule import MuleTask, worker
 from freezegun import freeze_time
+from nanohttp import settings
+from sqlalchemy import inspect
+
+from restfulpy.mule import MuleTask, JobTimer, worker
 
 
 awesome_task_done = threading.Event()
 another_task_done = threading.Event()
+executions = Counter()
+executions_lock = threading.Lock()
 
 class AwesomeTask(MuleTask):
 
@@ -37,6 +44,36 @@ class BadTask(MuleTask):
         raise Exception()
 
 
+class CountedJob(MuleTask):
+
+    __mapper_args__ = {
+        'polymorphic_identity': 'counted_job'
+    }
+
+    def do_(self, context):
+        with executions_lock:
+            executions[self.id] += 1
+
+
+class RecurringTask(MuleTask):
+    __schedule__ = 3600
+
+    __mapper_args__ = {
+        'polymorphic_identity': 'recurring_task'
+    }
+
+    def do_(self, context):
+        pass
+
+
+class CronTask(MuleTask):
+    __schedule__ = '0 3 * * *'
+
+    __mapper_args__ = {
+        'polymorphic_identity': 'cron_task'
+    }
+
+
 def test_worker(db):
     session = db()
     awesome_task = AwesomeTask()
@@ -76,3 +113,215 @@ def test_worker(db):
     tasks = worker(tries=0, filters=MuleTask.type == 'bad_task')
     assert len(tasks) == 0
 
+
+def test_indexes(db):
+    session = db()
+    indexes = {
+        i['name'] for i in inspect(session.bind).get_indexes('mule_task')
+    }
+    assert 'ix_mule_task_pending' in indexes
+
+
+def test_renew_stale(db):
+    session = db()
+    now = datetime.datetime.utcnow()
+    for i in range(3):
+        session.add(AwesomeTask(
+            status='in-progress',
+            started_at=now - datetime.timedelta(minutes=10),
+        ))
+    session.add(AwesomeTask(status='in-progress', started_at=now))
+    session.commit()
+
+    renewed = MuleTask.renew_stale(
+        now - datetime.timedelta(minutes=5),
+        session,
+        batch_size=2,
+    )
+    assert renewed == 3
+    assert session.query(MuleTask) \
+        .filter(MuleTask.status == 'new') \
+        .count() == 3
+
+
+def test_recurring(db):
+    session = db()
+    filters = MuleTask.type == 'recurring_task'
+
+    # The first occurrences are created by the worker
+    assert worker(tries=0, filters=filters) == []
+    occurrence = session.query(RecurringTask).one()
+    assert occurrence.recurring is True
+    assert occurrence.status == 'new'
+    assert session.query(CronTask).one().at.hour == 3
+
+    MuleTask.schedule_recurring(session)
+    assert RecurringTask.schedule_next(session=session) is None
+    assert session.query(RecurringTask).count() == 1
+
+    occurrence.at = datetime.datetime.utcnow() - datetime.timedelta(minutes=1)
+    session.commit()
+    assert worker(tries=0, filters=filters) == [(occurrence.id, 'success')]
+
+    session.refresh(occurrence)
+    next_occurrence = session.query(RecurringTask) \
+        .filter(RecurringTask.status == 'new') \
+        .one()
+    assert next_occurrence.recurring is True
+    assert next_occurrence.at - occurrence.at == datetime.timedelta(hours=1)
+
+
+def test_next_occurrence():
+    now = datetime.datetime.utcnow()
+    hour = datetime.timedelta(hours=1)
+
+    # The missed occurrences are skipped
+    at = RecurringTask.get_next_occurrence(now - 3 * hour - hour / 2)
+    assert at == now + hour / 2
+
+    at = CronTask.get_next_occurrence(now)
+    assert (at.hour, at.minute) == (3, 0)
+    assert now < at <= now + 24 * hour
+
+
+def test_job_timer():
+    now = datetime.datetime.utcnow()
+    timer = JobTimer()
+    assert timer.timeout(10) == 10
+
+    timer.push(now - datetime.timedelta(seconds=1))
+    timer.push(now + datetime.timedelta(seconds=5))
+    timer.push(now + datetime.timedelta(seconds=60))
+    timer.stale = False
+    assert 4 < timer.timeout(10) <= 5
+    assert len(timer.heap) == 2
+    assert timer.stale is False
+
+
+def test_pop_many(db):
+    session = db()
+    now = datetime.datetime.utcnow()
+    minute = datetime.timedelta(minutes=1)
+    for at in (now - 3 * minute, now - minute, now - 2 * minute, now + minute):
+        session.add(CountedJob(at=at))
+    session.add(CountedJob(at=now - 4 * minute, status='in-progress'))
+    session.add(CountedJob(
+        at=now - 5 * minute,
+        status='failed',
+        expired_at=now + minute,
+    ))
+    session.add(CountedJob(
+        at=now - 6 * minute,
+        status='failed',
+        expired_at=now - minute,
+    ))
+    session.commit()
+
+    filters = MuleTask.type == 'counted_job'
+    tasks = MuleTask.pop_many(2, filters=filters, session=session)
+    assert [t.at for t in tasks] == sorted(t.at for t in tasks)
+    assert [t.status for t in tasks] == ['in-progress', 'in-progress']
+    assert tasks[0].expired_at is not None
+    assert isinstance(tasks[0], CountedJob)
+
+    tasks = MuleTask.pop_many(10, filters=filters, session=session)
+    assert len(tasks) == 2
+    assert tasks[0].at < tasks[1].at
+
+    assert MuleTask.pop_many(10, filters=filters, session=session) == []
+
+
+def test_concurrent_workers(db):
+    session = db()
+    interval = settings.jobs.interval
+    settings.jobs.interval = .01
+
+    try:
+        count = 100
+        for i in range(count):
+            session.add(CountedJob())
+        session.commit()
+
+        stop = threading.Event()
+        results = []
+
+        def run():
+            results.extend(worker(
+                filters=MuleTask.type == 'counted_job',
+                stop=stop,
+            ))
+
+        threads = [threading.Thread(target=run) for i in range(4)]
+        for thread in threads:
+            thread.start()
+
+        deadline = time.monotonic() + 30
+        while sum(executions.values()) < count and time.monotonic() < deadline:
+            time.sleep(.1)
+
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+        # Each job is executed exactly once
+        assert len(executions) == count
+        assert set(executions.values()) == {1}
+        assert sorted(task_id for task_id, _ in results) == sorted(executions)
+        assert session.query(CountedJob) \
+            .filter(CountedJob.status == 'success') \
+            .count() == count
+
+    finally:
+        settings.jobs.interval = interval
+
+
+def test_worker_drains_jobs(db):
+    session = db()
+    interval = settings.jobs.interval
+    settings.jobs.interval = 10
+    try:
+        for i in range(5):
+            session.add(AwesomeTask())
+        session.commit()
+
+        # The due jobs are popped one after another, without any wait
+        started_at = time.monotonic()
+        tasks = worker(tries=0, filters=MuleTask.type == 'awesome_task')
+        assert len(tasks) == 5
+        assert time.monotonic() - started_at < 5
+
+        # The failed jobs to retry wake the worker up after the interval
+        now = datetime.datetime.utcnow()
+        session.add(BadTask(
+            status='failed',
+            expired_at=now + datetime.timedelta(days=1),
+        ))
+        session.commit()
+
+        timer = JobTimer()
+        timer.load(session)
+        assert 9 < timer.timeout(60) <= 10
+
+    finally:
+        settings.jobs.interval = interval
+
+
+def test_polling_worker_sleeps_until_due_job(db):
+    session = db()
+    interval = settings.jobs.interval
+    settings.jobs.interval = 10
+    try:
+        session.add(AwesomeTask(
+            at=datetime.datetime.utcnow() + datetime.timedelta(seconds=1)
+        ))
+        session.commit()
+
+        # Without a notification channel, the worker wakes up when the job
+        # is due, instead of after the interval
+        started_at = time.monotonic()
+        tasks = worker(tries=2, filters=MuleTask.type == 'awesome_task')
+        assert len(tasks) == 1
+        assert time.monotonic() - started_at < 5
+
+    finally:
+        settings.jobs.interval = interval
@@ -1,5 +1,6 @@
-from datetime import date, time
+from datetime import date, time, datetime
 
+import ujson
 from nanohttp import settings
 from nanohttp.contexts import Context
 from sqlalchemy import Integer, Unicode, ForeignKey, Boolean, Date, \
@@ -181,6 +182,42 @@ class Post(ModifiedMixin, DeclarativeBase):
         return post_dict
 
 
+class Note(DeclarativeBase):
+    __tablename__ = 'note'
+    id = Field(Integer, primary_key=True)
+    content = Field(Unicode(100))
+
+    @classmethod
+    def prepare_for_export(cls, column, v, **kwargs):
+        name, value = super().prepare_for_export(column, v, **kwargs)
+        if isinstance(value, str):
+            value = value.upper()
+
+        return name, value
+
+
+class Song(DeclarativeBase):
+    __tablename__ = 'song'
+    id = Field(Integer, primary_key=True)
+    title = Field(Unicode(50))
+    playlist_id = Field(ForeignKey('playlist.id'), json='playlistId')
+
+
+class Playlist(DeclarativeBase):
+    __tablename__ = 'playlist'
+    id = Field(Integer, primary_key=True)
+    title = Field(Unicode(50))
+    songs = relationship(Song, lazy='joined', protected=False)
+
+
+def export_one_by_one(model, **kwargs):
+    result = {}
+    for c in model.iter_json_columns(**kwargs):
+        result.setdefault(*model.prepare_for_export(c, getattr(model, c.key)))
+
+    return result
+
+
 def test_model(db):
     session = db()
 
@@ -294,3 +331,68 @@ def test_metadata(db):
 
     assert Comment.import_value(Comment.__table__.c.special, 'TRUE') is True
 
+
+def test_export_plan(db):
+    session = db()
+    settings.merge('timezone:')
+
+    with Context({}):
+        author = Author(
+            title='author1',
+            email='author1@example.org',
+            first_name='first name',
+            last_name='last name',
+            password='123456',
+            birth=date(2000, 1, 1),
+            weight=1.1
+        )
+        post = Post(title='First post', author=author, tag_time=time(1, 2))
+        post.comments.append(Comment(content='comment'))
+        note = Note(content='note')
+        session.add_all([post, note])
+        session.commit()
+
+        for kwargs in (
+            {},
+            {'include_mask_columns': False},
+            {'include_protected_columns': True},
+            {'relationships': False},
+        ):
+            for model in (author, post, post.comments[0]):
+                assert model.to_dict(**kwargs) == \
+                    export_one_by_one(model, **kwargs)
+
+        plan = Author.get_export_plan()
+        assert Author.get_export_plan() is plan
+        assert ('first_name', 'firstName') in [p[:2] for p in plan]
+        assert Author.get_export_plan(include_mask_columns=False) is not plan
+
+        # A value of an unexpected type
+        author.birth = datetime(2000, 1, 2, 3)
+        author.age = '20'
+        assert author.to_dict() == export_one_by_one(author)
+
+        # The overridden methods are respected
+        assert Note.get_export_plan() is None
+        assert note.to_dict()['content'] == 'NOTE'
+
+
+def test_stream_joined_collections(db):
+    session = db()
+
+    with Context({}):
+        for i in range(3):
+            session.add(Playlist(
+                title=f'playlist{i}',
+                songs=[Song(title=f'song{i}{j}') for j in range(2)]
+            ))
+        session.commit()
+
+        query = session.query(Playlist).order_by(Playlist.id)
+        expected = [p.to_dict() for p in query]
+        session.expire_all()
+
+        # The joined eager loaded collections are not fetched by yield_per
+        result = b''.join(Playlist.stream_query(query, chunk_size=2))
+        assert ujson.loads(result) == expected
+        assert [len(p['songs']) for p in expected] == [2, 2, 2]
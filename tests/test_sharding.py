@@ -0,0 +1,214 @@
+import threading
+import time
+from collections import Counter
+
+import pytest
+from nanohttp import context as ctx, settings
+from nanohttp.contexts import Context
+from sqlalchemy import select, literal
+
+from restfulpy.configuration import configure
+from restfulpy.orm import ShardedSession, create_thread_unsafe_session
+from restfulpy.sharding import HashRing, ShardScheduler, parse_shard_key, \
+    for_each_shard, DEFAULT_SHARD_KEY, ShardEngineRegistry, ShardDirectory
+
+
+class FakeDirectory:
+    def __init__(self, keys):
+        self.keys = keys
+
+    def owned_keys(self):
+        return list(self.keys)
+
+
+class FakeEngineRegistry(ShardEngineRegistry):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.urls = {}
+        self.lookups = 0
+
+    def get_connection_string(self, shard_key):
+        self.lookups += 1
+        return self.urls.get(shard_key, settings.db.url)
+
+
+def test_parse_shard_key():
+    assert parse_shard_key(b'sharding:foo:connection-string') == 'foo'
+    assert parse_shard_key('sharding:bar:connection-string') == 'bar'
+
+
+def test_hash_ring():
+    keys = [f'shard{i}' for i in range(1000)]
+    ring = HashRing(['host1', 'host2', 'host3'])
+    owners = {k: ring.get(k) for k in keys}
+    counts = Counter(owners.values())
+    assert set(counts) == {'host1', 'host2', 'host3'}
+    assert all(c > 200 for c in counts.values())
+
+    # Adding a host moves only the shards which it owns now
+    ring = HashRing(['host1', 'host2', 'host3', 'host4'])
+    moved = [k for k in keys if ring.get(k) != owners[k]]
+    assert all(ring.get(k) == 'host4' for k in moved)
+    assert len(moved) < 400
+
+    assert HashRing([]).get('shard1') is None
+
+
+def test_shard_directory_host():
+    configure(force=True)
+    settings.sharding.hosts = ['host1', 'host2']
+    settings.sharding.host = 'host1'
+    ShardDirectory().check_host()
+
+    # A host out of the ring owns no shard
+    settings.sharding.host = 'host3'
+    with pytest.raises(ValueError):
+        ShardDirectory().check_host()
+
+
+def test_shard_scheduler(db):
+    db()
+    runs = Counter()
+    shard_keys = []
+    slow_started = threading.Event()
+    release_slow = threading.Event()
+    stop = threading.Event()
+
+    def work(shard_key, session):
+        shard_keys.append(ctx.shard_key)
+        runs[shard_key] += 1
+        if shard_key == 'slow':
+            slow_started.set()
+            release_slow.wait(10)
+
+        if runs['fast1'] >= 20 and runs['fast2'] >= 20:
+            stop.set()
+
+        # Pretends to be busy, to be run again immediately
+        return shard_key != 'idle'
+
+    directory = FakeDirectory(['slow', 'fast1', 'fast2', 'idle'])
+    scheduler = ShardScheduler(
+        work,
+        size=3,
+        interval=10,
+        directory=directory,
+    )
+    thread = threading.Thread(target=scheduler.run, args=(stop, ))
+    thread.start()
+
+    assert slow_started.wait(10)
+    # The slow shard does not delay the others
+    assert stop.wait(10)
+    assert runs['slow'] == 1
+    assert runs['idle'] == 1
+
+    release_slow.set()
+    thread.join()
+    assert set(shard_keys) == set(directory.keys)
+    assert scheduler.sessions == {}
+
+
+def test_shard_scheduler_removed_shard(db):
+    db()
+    stop = threading.Event()
+    directory = FakeDirectory(['shard1', 'shard2'])
+    removed = threading.Event()
+    sessions = {}
+
+    def work(shard_key, session):
+        sessions.setdefault(shard_key, session)
+        assert sessions[shard_key] is session
+        if shard_key == 'shard2':
+            directory.keys = ['shard1']
+            removed.set()
+
+        if removed.is_set() and shard_key == 'shard1':
+            time.sleep(.1)
+            if 'shard2' not in scheduler.sessions:
+                stop.set()
+
+        return True
+
+    scheduler = ShardScheduler(
+        work,
+        size=2,
+        interval=10,
+        directory=directory,
+    )
+    thread = threading.Thread(target=scheduler.run, args=(stop, ))
+    thread.start()
+    assert stop.wait(10)
+    thread.join()
+
+
+def test_for_each_shard(db):
+    session = db()
+
+    def work(shard_key, session):
+        return shard_key, ctx.shard_key, session
+
+    with Context({}):
+        assert for_each_shard(work, session) == {
+            DEFAULT_SHARD_KEY: (DEFAULT_SHARD_KEY, DEFAULT_SHARD_KEY, session)
+        }
+
+
+def test_shard_engine_registry(db):
+    db()
+    registry = FakeEngineRegistry(max_engines=2, refresh_interval=3600)
+    try:
+        engine1 = registry.get('shard1')
+        assert registry.get('shard1') is engine1
+        assert registry.lookups == 1
+
+        # The least recently used engine is evicted
+        registry.get('shard2')
+        registry.get('shard1')
+        registry.get('shard3')
+        assert 'shard2' not in registry
+        assert 'shard1' in registry
+        assert len(registry) == 2
+
+        # But not while it's in use
+        with engine1.connect():
+            registry.get('shard2')
+            assert 'shard1' in registry
+            assert 'shard3' not in registry
+
+        # The engine is replaced when the connection string is changed
+        registry.refresh_interval = 0
+        registry.urls['shard1'] = f'{settings.db.url}?application_name=foo'
+        engine2 = registry.get('shard1')
+        assert engine2 is not engine1
+        assert registry.get('shard1') is engine2
+
+    finally:
+        registry.dispose()
+
+    assert len(registry) == 0
+
+
+def test_sharded_session(db):
+    db()
+    registry = FakeEngineRegistry()
+    ShardedSession.shard_engines = registry
+    session = create_thread_unsafe_session()
+    try:
+        default_bind = session.get_bind()
+        assert default_bind is not None
+        assert len(registry) == 0
+
+        with Context({}):
+            ctx.shard_key = 'shard1'
+            assert session.get_bind() is registry.get('shard1')
+            assert session.execute(select(literal(1))).scalar() == 1
+            session.commit()
+
+        assert session.get_bind() is default_bind
+        assert registry.lookups == 1
+
+    finally:
+        session.close()
+        ShardedSession.shard_engines = None
+        registry.dispose()
@@ -0,0 +1,53 @@
+import signal
+import threading
+import time
+
+from restfulpy.configuration import configure
+from restfulpy.supervisor import Supervisor
+
+
+def test_supervisor():
+    configure(force=True)
+    calls = []
+    lock = threading.Lock()
+
+    def target(stop, crash):
+        with lock:
+            calls.append(threading.current_thread().name)
+            first_call = len(calls) == 1
+
+        if crash and first_call:
+            raise Exception('Crashed')
+
+        stop.wait()
+
+    supervisor = Supervisor(
+        target,
+        number_of_workers=2,
+        check_interval=.1,
+        drain_timeout=2,
+        restart_delay=.2,
+        crash=True,
+    )
+    supervisor.start()
+    assert len(supervisor.workers) == 2
+
+    timer = threading.Timer(
+        1,
+        supervisor.signal_handler,
+        args=(signal.SIGTERM, None)
+    )
+    timer.start()
+    supervisor.watch()
+    timer.join()
+
+    # The crashed worker is restarted after the delay
+    assert len(calls) == 3
+    assert list(supervisor.crashes.values()) == [1]
+    assert all(w.is_alive() for w in supervisor.workers)
+
+    supervisor.stop.set()
+    started_at = time.monotonic()
+    supervisor.drain()
+    assert time.monotonic() - started_at < 2
+    assert not any(w.is_alive() for w in supervisor.workers)
@@ -1,15 +1,22 @@
-from datetime import datetime
+import asyncio
 import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
 
-from sqlalchemy import Integer
+from nanohttp import settings
+from sqlalchemy import Integer, ForeignKey, inspect, text, event
 from sqlalchemy.orm import object_session
 
-from restfulpy.orm import Field
-from restfulpy.taskqueue import RestfulpyTask, worker
+from restfulpy.db import PostgreSQLListener
+from restfulpy.lease import Heartbeat
+from restfulpy.orm import Field, DBSession
+from restfulpy.taskqueue import RestfulpyTask, worker, async_worker
 
 
 awesome_task_done = threading.Event()
 another_task_done = threading.Event()
+hanging_task_cancelled = threading.Event()
 
 
 class AwesomeTask(RestfulpyTask):
@@ -64,6 +71,120 @@ class RetryTask(RestfulpyTask):
         if self.retries % 3 != 0:
             raise Exception()
 
+
+class BackoffTask(RestfulpyTask):
+    __retry_backoff__ = 60
+    __retry_jitter__ = 0
+
+    __mapper_args__ = {
+        'polymorphic_identity': 'backoff_task'
+    }
+
+    def do_(self, context):
+        raise Exception()
+
+
+class LimitedTask(RestfulpyTask):
+    __concurrency__ = 2
+
+    __mapper_args__ = {
+        'polymorphic_identity': 'limited_task'
+    }
+
+    def do_(self, context):
+        pass
+
+
+class HeavyTask(RestfulpyTask):
+    __weight__ = 2
+
+    __mapper_args__ = {
+        'polymorphic_identity': 'heavy_task'
+    }
+
+    def do_(self, context):
+        pass
+
+
+class SpawningTask(RestfulpyTask):
+
+    __mapper_args__ = {
+        'polymorphic_identity': 'spawning_task'
+    }
+
+    def do_(self, context):
+        DBSession.add(AwesomeTask(priority=self.priority))
+
+
+class TimedSpawningTask(SpawningTask):
+    __timeout__ = 5
+
+    __mapper_args__ = {
+        'polymorphic_identity': 'timed_spawning_task'
+    }
+
+
+class HangingTask(RestfulpyTask):
+    __timeout__ = .5
+
+    __mapper_args__ = {
+        'polymorphic_identity': 'hanging_task'
+    }
+
+    def do_(self, context):
+        if context['cancelled'].wait(10):
+            hanging_task_cancelled.set()
+
+
+class AsyncTask(RestfulpyTask):
+    __timeout__ = 2
+
+    __mapper_args__ = {
+        'polymorphic_identity': 'async_task'
+    }
+
+    duration = Field(Integer, nullable=True)
+
+    async def do_async(self, context):
+        await asyncio.sleep(self.duration / 10)
+
+
+class FlakyAsyncTask(RestfulpyTask):
+    __max_retries__ = 2
+    __timeout__ = 2
+
+    __mapper_args__ = {
+        'polymorphic_identity': 'flaky_async_task'
+    }
+
+    async def do_async(self, context):
+        # Such as a network timeout
+        raise asyncio.TimeoutError()
+
+
+class JoinedTask(RestfulpyTask):
+    __tablename__ = 'joined_task'
+
+    id = Field(Integer, ForeignKey('restfulpy_task.id'), primary_key=True)
+
+    __mapper_args__ = {
+        'polymorphic_identity': 'joined_task'
+    }
+
+    def do_(self, context):
+        pass
+
+
+class GrandchildTask(JoinedTask):
+    __tablename__ = 'grandchild_task'
+
+    id = Field(Integer, ForeignKey('joined_task.id'), primary_key=True)
+
+    __mapper_args__ = {
+        'polymorphic_identity': 'grandchild_task'
+    }
+
+
 def test_worker(db):
     session = db()
     awesome_task = AwesomeTask()
@@ -134,3 +255,513 @@ def test_worker(db):
     assert tasks[0].status == 'failed'
     assert tasks[0].retries == 2
 
+
+def test_pop_many(db):
+    session = db()
+    for priority in (10, 30, 20):
+        session.add(AwesomeTask(priority=priority))
+    session.add(AnotherTask(priority=40))
+    session.commit()
+
+    tasks = RestfulpyTask.pop_many(
+        2,
+        filters=RestfulpyTask.type == 'awesome_task',
+        session=session,
+    )
+    assert len(tasks) == 2
+    assert [t.priority for t in tasks] == [30, 20]
+    assert all(isinstance(t, AwesomeTask) for t in tasks)
+    assert all(t.status == 'in-progress' for t in tasks)
+    assert all(t.retries == 1 for t in tasks)
+
+    tasks = RestfulpyTask.pop_many(5, session=session)
+    assert len(tasks) == 2
+    assert isinstance(tasks[0], AnotherTask)
+    assert isinstance(tasks[1], AwesomeTask)
+
+    assert RestfulpyTask.pop_many(5, session=session) == []
+
+
+def test_worker_batch(db):
+    session = db()
+    for i in range(5):
+        session.add(AwesomeTask())
+    session.commit()
+
+    tasks = worker(
+        tries=0,
+        filters=RestfulpyTask.type == 'awesome_task',
+        batch_size=2,
+    )
+    assert len(tasks) == 5
+    assert all(status == 'success' for _, status in tasks)
+
+
+def test_notification(db):
+    session = db()
+    settings.worker.notification_channel = 'restfulpy_task'
+
+    try:
+        with PostgreSQLListener('restfulpy_task') as listener:
+            assert listener.wait(0) is False
+
+            statements = []
+
+            def before_cursor_execute(conn, cursor, statement, *args):
+                statements.append(statement)
+
+            event.listen(
+                session.bind,
+                'before_cursor_execute',
+                before_cursor_execute
+            )
+            try:
+                session.add(AwesomeTask())
+                session.add(AwesomeTask())
+                session.commit()
+            finally:
+                event.remove(
+                    session.bind,
+                    'before_cursor_execute',
+                    before_cursor_execute
+                )
+
+            # A single notification per flush, not per inserted row
+            assert sum('pg_notify' in s for s in statements) == 1
+            assert listener.wait(5) is True
+            assert listener.wait(0) is False
+
+    finally:
+        settings.worker.notification_channel = None
+
+
+def test_indexes(db):
+    session = db()
+    indexes = {
+        i['name'] for i in inspect(session.bind).get_indexes('restfulpy_task')
+    }
+    assert 'ix_restfulpy_task_pending' in indexes
+    assert 'ix_restfulpy_task_pending_type' in indexes
+    assert 'ix_restfulpy_task_dedup_key' in indexes
+    assert 'ix_restfulpy_task_in_progress' in indexes
+
+
+def test_cleanup(db):
+    session = db()
+    yesterday = datetime.utcnow() - timedelta(days=1)
+    for task_class in (AwesomeTask, JoinedTask, GrandchildTask):
+        session.add(task_class(status='success', started_at=yesterday))
+        session.add(task_class(status='success', started_at=yesterday))
+        session.add(task_class(status='failed', started_at=yesterday))
+    session.add(AwesomeTask(status='success', started_at=datetime.utcnow()))
+    session.commit()
+
+    tables = list(RestfulpyTask.iter_tables())
+    assert tables.index(GrandchildTask.__table__) < \
+        tables.index(JoinedTask.__table__) < \
+        tables.index(RestfulpyTask.__table__)
+
+    session.execute(text(
+        'CREATE TABLE restfulpy_task_history (LIKE restfulpy_task)'
+    ))
+    for table in ('joined_task', 'grandchild_task'):
+        session.execute(text(
+            f'CREATE TABLE restfulpy_task_history_{table} (LIKE {table})'
+        ))
+    session.commit()
+
+    deleted = RestfulpyTask.cleanup(
+        datetime.utcnow() - timedelta(hours=1),
+        session,
+        batch_size=4,
+        archive_table='restfulpy_task_history',
+    )
+    assert deleted == 6
+    assert session.query(RestfulpyTask).count() == 4
+    assert session.query(JoinedTask).count() == 2
+    assert session.query(GrandchildTask).count() == 1
+    archived = {
+        table: session.execute(
+            text(f'SELECT count(*) FROM {table}')
+        ).scalar()
+        for table in (
+            'restfulpy_task_history',
+            'restfulpy_task_history_joined_task',
+            'restfulpy_task_history_grandchild_task',
+        )
+    }
+    assert archived == {
+        'restfulpy_task_history': 6,
+        'restfulpy_task_history_joined_task': 4,
+        'restfulpy_task_history_grandchild_task': 2,
+    }
+
+
+def test_renew_stale(db):
+    session = db()
+    ten_minutes_ago = datetime.utcnow() - timedelta(minutes=10)
+    for i in range(5):
+        session.add(
+            AwesomeTask(status='in-progress', started_at=ten_minutes_ago)
+        )
+    session.add(AwesomeTask(status='in-progress', started_at=datetime.utcnow()))
+    session.commit()
+
+    renewed = RestfulpyTask.renew_stale(
+        datetime.utcnow() - timedelta(minutes=5),
+        session,
+        batch_size=2,
+    )
+    assert renewed == 5
+    assert session.query(RestfulpyTask) \
+        .filter(RestfulpyTask.status == 'new') \
+        .filter(RestfulpyTask.started_at.is_(None)) \
+        .count() == 5
+
+
+def test_lease(db):
+    session = db()
+    session.add(AwesomeTask())
+    session.add(AwesomeTask())
+    session.commit()
+
+    tasks = RestfulpyTask.pop_many(2, session=session, worker_id='worker-1')
+    assert all(t.worker_id == 'worker-1' for t in tasks)
+    assert all(t.lease_expires_at is not None for t in tasks)
+
+    session.query(RestfulpyTask).update({
+        'lease_expires_at': datetime.utcnow() - timedelta(minutes=1)
+    })
+    session.commit()
+
+    heartbeat = Heartbeat(RestfulpyTask.__table__, 'worker-1', 60, .1)
+    heartbeat.add(tasks[0].id)
+    heartbeat.start()
+    time.sleep(1)
+    heartbeat.stop()
+
+    # Only the task without heartbeat is renewed, even it's started recently
+    renewed = RestfulpyTask.renew_stale(
+        datetime.utcnow() - timedelta(minutes=5),
+        session,
+    )
+    assert renewed == 1
+
+    session.refresh(tasks[0])
+    session.refresh(tasks[1])
+    assert tasks[0].status == 'in-progress'
+    assert tasks[1].status == 'new'
+    assert tasks[1].worker_id is None
+
+
+def test_retry_backoff(db):
+    session = db()
+    task = BackoffTask()
+    session.add(task)
+    session.commit()
+
+    filters = RestfulpyTask.type == 'backoff_task'
+    tasks = worker(tries=0, filters=filters)
+    assert tasks == [(task.id, 'new')]
+
+    session.refresh(task)
+    assert task.retries == 1
+    assert task.run_after - task.started_at >= timedelta(seconds=60)
+    assert RestfulpyTask.next_run_after(session=session) == task.run_after
+
+    # Postponed, so it's not popped again
+    assert worker(tries=0, filters=filters) == []
+
+    task.run_after = datetime.utcnow() - timedelta(seconds=1)
+    session.commit()
+    assert worker(tries=0, filters=filters) == [(task.id, 'new')]
+
+    session.refresh(task)
+    assert task.retries == 2
+    assert task.get_retry_delay() == 120
+
+    task.retries = 20
+    assert task.get_retry_delay() == BackoffTask.__retry_backoff_max__
+
+
+def test_fair_scheduling(db):
+    session = db()
+    for i in range(5):
+        session.add(AwesomeTask())
+        session.add(LimitedTask())
+        session.add(HeavyTask())
+    session.commit()
+
+    filters = RestfulpyTask.type.in_(
+        ['awesome_task', 'limited_task', 'heavy_task']
+    )
+
+    # Virtual times: heavy_task: .5, 1, ..., the others: 1, 2, ...
+    tasks = RestfulpyTask.pop_many(4, filters=filters, session=session)
+    assert Counter(t.type for t in tasks) == \
+        dict(heavy_task=2, limited_task=1, awesome_task=1)
+
+    # Only one more limited_task is allowed
+    tasks = RestfulpyTask.pop_many(20, filters=filters, session=session)
+    assert Counter(t.type for t in tasks) == \
+        dict(heavy_task=3, limited_task=1, awesome_task=4)
+
+    assert RestfulpyTask.pop_many(20, filters=filters, session=session) == []
+
+    limited_task = tasks[[t.type for t in tasks].index('limited_task')]
+    limited_task.status = 'success'
+    session.commit()
+
+    tasks = RestfulpyTask.pop_many(20, filters=filters, session=session)
+    assert [t.type for t in tasks] == ['limited_task']
+
+
+def test_fair_scheduling_one_by_one(db):
+    session = db()
+
+    def pop(count, types):
+        filters = RestfulpyTask.type.in_(types)
+        return [
+            task.type
+            for _ in range(count)
+            for task in RestfulpyTask.pop_many(
+                1,
+                filters=filters,
+                session=session
+            )
+        ]
+
+    # A flood of one type does not starve the other one
+    for i in range(10):
+        session.add(AwesomeTask())
+    session.commit()
+    for i in range(2):
+        session.add(AnotherTask())
+    session.commit()
+
+    assert pop(4, ['awesome_task', 'another_task']) == \
+        ['awesome_task', 'another_task', 'awesome_task', 'another_task']
+
+    # The in progress tasks are counted, the virtual times of heavy_task:
+    # .5, 1, 1.5, ..., and awesome_task: 3, 4, ...
+    for i in range(6):
+        session.add(HeavyTask())
+    session.commit()
+
+    assert pop(7, ['awesome_task', 'heavy_task']) == \
+        ['heavy_task'] * 5 + ['awesome_task', 'heavy_task']
+
+
+def test_enqueue_many(db):
+    session = db()
+    ids = GrandchildTask.enqueue_many(
+        [dict(priority=10), dict(), dict(priority=30)],
+        session=session,
+    )
+    session.commit()
+    assert len(ids) == 3
+
+    tasks = RestfulpyTask.pop_many(
+        3,
+        filters=RestfulpyTask.type == 'grandchild_task',
+        session=session,
+    )
+    assert [t.priority for t in tasks] == [50, 30, 10]
+    assert all(isinstance(t, GrandchildTask) for t in tasks)
+    assert {t.id for t in tasks} == set(ids)
+
+
+def test_deduplication(db):
+    session = db()
+    first_id = AwesomeTask.enqueue(session, dedup_key='user:1', priority=10)
+    session.commit()
+
+    assert AwesomeTask.enqueue(
+        session,
+        on_conflict='ignore',
+        dedup_key='user:1',
+        priority=20,
+    ) is None
+
+    # Same key of the other types are allowed
+    assert AnotherTask.enqueue(session, dedup_key='user:1') is not None
+
+    ids = AwesomeTask.enqueue_many(
+        [
+            dict(dedup_key='user:1', priority=30),
+            dict(dedup_key='user:2', priority=40),
+            dict(dedup_key='user:2', priority=45),
+            dict(priority=50),
+        ],
+        session=session,
+        on_conflict='replace',
+    )
+    session.commit()
+    assert len(ids) == 3
+    assert ids[0] == first_id
+
+    tasks = session.query(AwesomeTask).order_by(AwesomeTask.priority).all()
+    assert [(t.dedup_key, t.priority) for t in tasks] == \
+        [('user:1', 30), ('user:2', 45), (None, 50)]
+
+    # Replacing a retried task resets its retries and backoff
+    retried = session.query(AwesomeTask) \
+        .filter(AwesomeTask.dedup_key == 'user:2') \
+        .one()
+    retried.retries = 2
+    retried.fail_reason = 'Failed'
+    retried.run_after = datetime.utcnow() + timedelta(hours=1)
+    session.commit()
+    assert AwesomeTask.enqueue(
+        session,
+        on_conflict='replace',
+        dedup_key='user:2',
+        priority=45,
+    ) == retried.id
+    session.commit()
+    session.refresh(retried)
+    assert retried.retries == 0
+    assert retried.fail_reason is None
+    assert retried.run_after is None
+
+    # The in-progress tasks are not replaced
+    task = AwesomeTask.pop(
+        filters=AwesomeTask.dedup_key == 'user:1',
+        session=session
+    )
+    assert AwesomeTask.enqueue(
+        session,
+        on_conflict='replace',
+        dedup_key='user:1',
+    ) is None
+
+    # But the finished ones don't prevent the new tasks
+    task.status = 'success'
+    session.commit()
+    assert AwesomeTask.enqueue(
+        session,
+        on_conflict='ignore',
+        dedup_key='user:1',
+    ) is not None
+
+    # Joined tables
+    joined_id = JoinedTask.enqueue(session, dedup_key='user:1')
+    assert JoinedTask.enqueue(
+        session,
+        on_conflict='replace',
+        dedup_key='user:1',
+        priority=1,
+    ) == joined_id
+    session.commit()
+    assert session.query(JoinedTask).filter(JoinedTask.id == joined_id) \
+        .one().priority == 1
+
+
+def test_timeout(db):
+    session = db()
+    hanging_task = HangingTask(priority=100)
+    session.add(hanging_task)
+    awesome_task = AwesomeTask()
+    session.add(awesome_task)
+    session.commit()
+
+    tasks = worker(
+        tries=0,
+        batch_size=2,
+        filters=RestfulpyTask.type.in_(['hanging_task', 'awesome_task']),
+    )
+    assert tasks == [
+        (hanging_task.id, 'failed'),
+        (awesome_task.id, 'success'),
+    ]
+    assert hanging_task_cancelled.wait(1)
+
+    # The connection of the abandoned session is not leaked
+    pool = session.bind.pool
+    deadline = time.monotonic() + 1
+    while pool.checkedout() and time.monotonic() < deadline:
+        time.sleep(.01)
+    assert pool.checkedout() == 0
+
+    session.refresh(hanging_task)
+    assert 'timed out' in hanging_task.fail_reason
+    assert hanging_task.terminated_at is not None
+
+    # Released after the timeout and popped again
+    session.refresh(awesome_task)
+    assert awesome_task.retries == 1
+
+
+def test_execute_db_session(db):
+    session = db()
+    spawning_task = SpawningTask(priority=10)
+    session.add(spawning_task)
+    timed_spawning_task = TimedSpawningTask(priority=20)
+    session.add(timed_spawning_task)
+    session.commit()
+
+    # The changes made through the DBSession are committed too, also in
+    # the thread of the task with a timeout.
+    tasks = worker(
+        tries=0,
+        filters=RestfulpyTask.type.in_(
+            ['spawning_task', 'timed_spawning_task']
+        ),
+    )
+    assert tasks == [
+        (timed_spawning_task.id, 'success'),
+        (spawning_task.id, 'success'),
+    ]
+    assert sorted(
+        t.priority for t in session.query(AwesomeTask)
+    ) == [10, 20]
+    assert not DBSession.registry.has()
+
+
+def test_async_worker(db):
+    session = db()
+    for i in range(10):
+        session.add(AsyncTask(duration=5))
+    hanging_task = AsyncTask(duration=100)
+    session.add(hanging_task)
+    session.add(AwesomeTask())
+    session.commit()
+
+    started_at = time.monotonic()
+    tasks = asyncio.run(async_worker(tries=0, batch_size=5, concurrency=20))
+    elapsed = time.monotonic() - started_at
+
+    # Only the async tasks, concurrently
+    assert len(tasks) == 11
+    assert elapsed < 4
+    assert sorted(status for _, status in tasks) == ['failed'] + \
+        ['success'] * 10
+
+    session.refresh(hanging_task)
+    assert hanging_task.status == 'failed'
+    assert 'timed out' in hanging_task.fail_reason
+
+    # The synchronous worker is also able to run the async tasks
+    task = AsyncTask(duration=1)
+    session.add(task)
+    session.commit()
+    tasks = worker(tries=0, filters=RestfulpyTask.type == 'async_task')
+    assert tasks == [(task.id, 'success')]
+
+
+def test_async_worker_timeout_error(db):
+    session = db()
+    task = FlakyAsyncTask()
+    session.add(task)
+    session.commit()
+
+    # A TimeoutError raised by the task is retried like the other errors
+    tasks = asyncio.run(async_worker(
+        tries=0,
+        filters=RestfulpyTask.type == 'flaky_async_task'
+    ))
+    assert tasks == [(task.id, 'new'), (task.id, 'failed')]
+
+    session.refresh(task)
+    assert 'TimeoutError' in task.fail_reason
+    assert 'timed out' not in task.fail_reason
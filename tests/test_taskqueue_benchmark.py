@@ -0,0 +1,88 @@
+from sqlalchemy import event
+
+from restfulpy.taskqueue import RestfulpyTask, worker
+
+
+class CountedTask(RestfulpyTask):
+
+    __mapper_args__ = {
+        'polymorphic_identity': 'counted_task'
+    }
+
+    def do_(self, context):
+        pass
+
+
+def count_queries(engine, func, *args, **kwargs):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+    return result, statements
+
+
+def pop_all(session, batch_size, filters):
+    tasks = []
+    while True:
+        batch = RestfulpyTask.pop_many(
+            batch_size,
+            filters=filters,
+            session=session,
+        )
+        if not batch:
+            return tasks
+
+        tasks.extend(batch)
+
+
+def test_queries_per_task(db):
+    session = db()
+    count = 20
+    filters = RestfulpyTask.type == 'counted_task'
+    CountedTask.enqueue_many([{}] * count, session=session)
+    session.commit()
+
+    def reset():
+        session.query(RestfulpyTask) \
+            .filter(filters) \
+            .update({'status': 'new'})
+        session.commit()
+
+    queries = {}
+    for batch_size in (1, 10):
+        tasks, statements = count_queries(
+            session.bind,
+            worker,
+            tries=0,
+            batch_size=batch_size,
+            filters=filters,
+        )
+        assert len(tasks) == count
+        assert all(status == 'success' for _, status in tasks)
+        reset()
+
+        popped, pop_statements = count_queries(
+            session.bind,
+            pop_all,
+            session,
+            batch_size,
+            filters,
+        )
+        assert len(popped) == count
+        reset()
+
+        queries[batch_size] = len(statements)
+
+        # Executing and finishing a task takes a single UPDATE. It used to
+        # take two queries: a SELECT to load the task again and an UPDATE.
+        assert len(statements) - len(pop_statements) == count
+
+    # Popping in batches takes fewer queries per task
+    assert queries[10] < queries[1]
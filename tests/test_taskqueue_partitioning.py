@@ -0,0 +1,67 @@
+from datetime import datetime, timedelta
+
+from nanohttp import settings
+from sqlalchemy import text
+
+from restfulpy.orm import metadata
+from restfulpy.taskqueue import RestfulpyTask
+
+
+class PartitionedTask(RestfulpyTask):
+
+    __mapper_args__ = {
+        'polymorphic_identity': 'partitioned_task'
+    }
+
+    def do_(self, context):
+        pass
+
+
+def partitions(session):
+    return set(session.execute(text(
+        'SELECT c.relname FROM pg_inherits i '
+        'JOIN pg_class c ON c.oid = i.inhrelid '
+        'JOIN pg_class p ON p.oid = i.inhparent '
+        'WHERE p.relname = \'restfulpy_task\''
+    )).scalars())
+
+
+def test_partitioning(db):
+    session = db()
+    settings.worker.partitioning.merge(dict(
+        enabled=True,
+        interval=10,
+        ahead=1,
+    ))
+
+    try:
+        metadata.drop_all(bind=session.bind)
+        metadata.create_all(bind=session.bind)
+        assert partitions(session) == {
+            'restfulpy_task_p0',
+            'restfulpy_task_p10',
+        }
+
+        two_days_ago = datetime.utcnow() - timedelta(days=2)
+        for i in range(15):
+            session.add(PartitionedTask(
+                status='success',
+                created_at=two_days_ago if i < 9 else datetime.utcnow(),
+            ))
+        session.commit()
+
+        RestfulpyTask.create_partitions(session)
+        session.commit()
+        assert 'restfulpy_task_p20' in partitions(session)
+
+        retired = RestfulpyTask.retire_partitions(
+            datetime.utcnow() - timedelta(days=1),
+            session,
+        )
+        session.commit()
+        assert retired == [0]
+        assert 'restfulpy_task_p0' not in partitions(session)
+        assert session.query(RestfulpyTask).count() == 6
+
+    finally:
+        settings.worker.partitioning.enabled = False